@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+# Microbenchmark of the JSON-RPC request encoding, via float or exact Decimals
+
+# Add python-bitcoinrpc to module search path:
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-bitcoinrpc"))
+
+import json
+import timeit
+from decimal import Decimal
+
+from bitcoinrpc.authproxy import EncodeDecimal, EncodeJSON
+
+MAX_AMOUNT = Decimal('92233720368.54775807')
+
+# Requests, as sent on the send path of TestEntity
+REQUESTS = {
+    'createrawtransaction': {
+        'version': '1.1', 'method': 'createrawtransaction', 'id': 1, 'params': (
+            [{'txid': 'ab' * 32, 'vout': 0, 'address': 'mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w'},
+             {'txid': 'cd' * 32, 'vout': 1, 'address': 'mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w'}],
+            {'moneyqMan7uh8FqdCA2BV5yZ8qVrc9ikLP': Decimal(1.23456789).quantize(Decimal('0.00000001')),
+             'mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w': Decimal('48.76533211')})},
+    'omni_send': {
+        'version': '1.1', 'method': 'omni_send', 'id': 2, 'params': (
+            'mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w', 'moneyqMan7uh8FqdCA2BV5yZ8qVrc9ikLP', 3, MAX_AMOUNT)},
+    'getblockcount': {
+        'version': '1.1', 'method': 'getblockcount', 'id': 3, 'params': ()},
+}
+
+
+def encode_via_float(request):
+    return json.dumps(request, default=EncodeDecimal)
+
+
+def encode_exact(request):
+    return EncodeJSON(request)
+
+
+def run(number=20000, repeat=5):
+    print('Exactness of %s:' % (MAX_AMOUNT,))
+    print('  via float: %s' % (encode_via_float([MAX_AMOUNT]),))
+    print('  exact:     %s' % (encode_exact([MAX_AMOUNT]),))
+    print('')
+    print('%-22s %14s %14s %9s' % ('request', 'via float us', 'exact us', 'speedup'))
+    for name in sorted(REQUESTS):
+        request = REQUESTS[name]
+        via_float = min(timeit.repeat(lambda: encode_via_float(request), number=number, repeat=repeat))
+        exact = min(timeit.repeat(lambda: encode_exact(request), number=number, repeat=repeat))
+        print('%-22s %14.2f %14.2f %8.2fx' % (
+            name, 1e6 * via_float / number, 1e6 * exact / number, via_float / exact))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+# Microbenchmark of the client-side cost of AuthServiceProxy calls
+#
+# Calls are answered by an in-memory connection, so only the method lookup,
+# request encoding and response decoding are measured, as paid by polling
+# loops like sync_blocks().
+
+# Add python-bitcoinrpc to module search path:
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-bitcoinrpc"))
+
+import time
+from decimal import Decimal
+
+from bitcoinrpc.authproxy import AuthServiceProxy
+
+URL = 'http://rt:rt@127.0.0.1:18332'
+
+
+class _CannedResponse(object):
+
+    def __init__(self, body):
+        self.__body = body
+
+    def read(self, size=None):
+        return self.__body
+
+
+class CannedConnection(object):
+    """Answers every request with the same response"""
+
+    def __init__(self, body):
+        self.body = body
+        self.requests = 0
+
+    def request(self, method, url, body=None, headers={}):
+        self.requests += 1
+
+    def getresponse(self):
+        return _CannedResponse(self.body)
+
+    def close(self):
+        pass
+
+
+CALLS = [
+    ('getblockcount', (), b'{"result":200,"error":null,"id":1}'),
+    ('getbestblockhash', (), b'{"result":"' + b'ab' * 32 + b'","error":null,"id":1}'),
+    ('omni_getbalance', ('mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w', 1),
+     b'{"result":{"balance":"250.00000000","reserved":"0.00000000"},"error":null,"id":1}'),
+    ('omni_send', ('mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w', 'moneyqMan7uh8FqdCA2BV5yZ8qVrc9ikLP', 3,
+                   Decimal('92233720368.54775807')),
+     b'{"result":"' + b'cd' * 32 + b'","error":null,"id":1}'),
+]
+
+
+def calls_per_second(method, args, body, duration):
+    proxy = AuthServiceProxy(URL, connection=CannedConnection(body))
+    calls = 0
+    started = time.time()
+    deadline = started + duration
+    while time.time() < deadline:
+        for i in range(100):
+            getattr(proxy, method)(*args)
+        calls += 100
+    return calls / (time.time() - started)
+
+
+def run(duration=1.0):
+    print('%-20s %14s' % ('method', 'calls/s'))
+    for method, args, body in CALLS:
+        print('%-20s %14.0f' % (method, calls_per_second(method, args, body, duration)))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python2
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+# Benchmark of AuthServiceProxy against a local stub JSON-RPC server
+#
+# The stub server runs in a separate process and answers with canned
+# responses shaped like those of Omni Core, from tiny getblockcount results
+# to huge omni_getorderbook arrays. Calls are measured one after another,
+# as batches, from several threads sharing a pooled proxy, and, on Python 3,
+# from one event loop via AsyncAuthServiceProxy. Finally, the cost to decode
+# the canned responses, as a whole or streamed, is reported per megabyte.
+
+# Add python-bitcoinrpc to module search path:
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-bitcoinrpc"))
+
+import json
+import multiprocessing
+import optparse
+import threading
+import time
+from decimal import Decimal
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from bitcoinrpc.authproxy import AuthServiceProxy, _ResultStream
+
+
+def canned_results(size):
+    """Results per method, where size is the number of elements of array results"""
+    txid = 'ab' * 32
+    address = 'mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w'
+    return {
+        'getblockcount': 200,
+        'omni_getbalance': {'balance': '250.00000000', 'reserved': '0.00000000'},
+        'getrawmempool': [('%064x' % i) for i in range(size)],
+        'omni_getorderbook': [{
+            'address': address, 'txid': txid, 'ecosystem': 'main',
+            'propertyidforsale': 3, 'propertyidforsaleisdivisible': True,
+            'amountforsale': '92233720368.54775807', 'amountremaining': '1.00000000',
+            'propertyiddesired': 1, 'propertyiddesiredisdivisible': True,
+            'amountdesired': '2.00000000', 'amounttofill': '2.00000000', 'action': 1,
+            'block': 200 + i % 100, 'blocktime': 1420000000 + i, 'unitprice': '2.00000000'}
+            for i in range(size)],
+        'listunspent': [{
+            'txid': txid, 'vout': i, 'address': address, 'account': '',
+            'scriptPubKey': '76a914' + '00' * 20 + '88ac', 'amount': Decimal('50.00000000') + i,
+            'confirmations': 101 + i, 'spendable': True}
+            for i in range(size)],
+    }
+
+
+def canned_bodies(size):
+    """Responses per method as (prefix, suffix), around the id"""
+    bodies = {}
+    for method, result in canned_results(size).items():
+        text = json.dumps({'result': result, 'error': None, 'id': 0},
+                          default=lambda d: float(d), separators=(',', ':'))
+        prefix, suffix = text.rsplit('"id":0', 1)
+        bodies[method] = (prefix + '"id":', suffix)
+    return bodies
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+        if isinstance(request, list):
+            body = '[' + ','.join(self.answer(call) for call in request) + ']'
+        else:
+            body = self.answer(request)
+        body = body.encode('utf8')
+        # Headers and body are written at once
+        self.wfile.write(('HTTP/1.1 200 OK\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: %d\r\n\r\n' % (len(body),)).encode('ascii') + body)
+
+    def answer(self, call):
+        if call['method'] not in self.server.bodies:
+            return json.dumps({'result': None, 'id': call['id'],
+                               'error': {'code': -32601, 'message': 'Method not found'}})
+        prefix, suffix = self.server.bodies[call['method']]
+        return prefix + json.dumps(call['id']) + suffix
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(size, port_queue):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.bodies = canned_bodies(size)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_stub_server(size):
+    """Start the stub server in a separate process, return the process and URL"""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(size, port_queue))
+    process.daemon = True
+    process.start()
+    return process, 'http://rt:rt@127.0.0.1:%d' % (port_queue.get(),)
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(mode, method, calls, elapsed, latencies):
+    print('%-12s %-18s %10.0f %10.3f %10.3f' % (
+        mode, method, calls / elapsed, 1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99)))
+
+
+def bench_single(url, method, args, duration):
+    proxy = AuthServiceProxy(url)
+    call = getattr(proxy, method)
+    latencies = []
+    started = time.time()
+    while time.time() - started < duration:
+        call_started = time.time()
+        call(*args)
+        latencies.append(time.time() - call_started)
+    report('single', method, len(latencies), time.time() - started, latencies)
+
+
+def bench_batched(url, method, args, duration, batch_size):
+    proxy = AuthServiceProxy(url)
+    latencies = []
+    started = time.time()
+    while time.time() - started < duration:
+        call_started = time.time()
+        batch = proxy.batch()
+        for i in range(batch_size):
+            getattr(batch, method)(*args)
+        batch.execute()
+        latencies.append(time.time() - call_started)
+    # Latencies are per batch, throughput per call
+    report('batch(%d)' % (batch_size,), method, batch_size * len(latencies), time.time() - started, latencies)
+
+
+def bench_threads(url, method, args, duration, threads):
+    proxy = AuthServiceProxy(url, pool_size=threads)
+    latencies = []
+    started = time.time()
+
+    def worker():
+        call = getattr(proxy, method)
+        while time.time() - started < duration:
+            call_started = time.time()
+            call(*args)
+            latencies.append(time.time() - call_started)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    report('threads(%d)' % (threads,), method, len(latencies), time.time() - started, latencies)
+
+
+def bench_async(url, method, args, duration, concurrency):
+    # Written with callbacks instead of async def, so this file still compiles with Python 2
+    import asyncio
+    from bitcoinrpc.asyncproxy import AsyncAuthServiceProxy
+
+    loop = asyncio.new_event_loop()
+    proxy = AsyncAuthServiceProxy(url, pool_size=concurrency)
+    call = getattr(proxy, method)
+    done = loop.create_future()
+    active = [concurrency]
+    latencies = []
+    started = time.time()
+
+    def next_call():
+        if time.time() - started >= duration:
+            active[0] -= 1
+            if not active[0] and not done.done():
+                done.set_result(None)
+            return
+        call_started = time.time()
+
+        def finished(task):
+            if task.exception() is not None:
+                if not done.done():
+                    done.set_exception(task.exception())
+                return
+            latencies.append(time.time() - call_started)
+            next_call()
+
+        loop.create_task(call(*args)).add_done_callback(finished)
+
+    for i in range(concurrency):
+        next_call()
+    try:
+        loop.run_until_complete(done)
+    finally:
+        proxy.close()
+        loop.close()
+    report('async(%d)' % (concurrency,), method, len(latencies), time.time() - started, latencies)
+
+
+def bench_decoding(size, repeat=5):
+    """Decode cost per MB of the canned responses, as a whole or streamed"""
+    import io
+    decode = AuthServiceProxy('http://rt:rt@127.0.0.1:1')._AuthServiceProxy__decode_response
+    print('')
+    print('%-18s %10s %14s %14s' % ('method', 'size MB', 'whole ms/MB', 'stream ms/MB'))
+    for method, (prefix, suffix) in sorted(canned_bodies(size).items()):
+        body = (prefix + '1' + suffix).encode('utf8')
+        megabytes = len(body) / 1e6
+        whole = min(timed(lambda: decode(body)) for i in range(repeat))
+        streamed = min(timed(lambda: list(_ResultStream(io.BytesIO(body)).items())) for i in range(repeat))
+        print('%-18s %10.3f %14.2f %14.2f' % (method, megabytes, 1000 * whole / megabytes,
+                                               1000 * streamed / megabytes))
+
+
+def timed(function):
+    started = time.time()
+    function()
+    return time.time() - started
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--duration", dest="duration", default=2.0, type="float",
+                      help="Seconds per measurement (default: %default)")
+    parser.add_option("--size", dest="size", default=10000, type="int",
+                      help="Number of elements of large array results (default: %default)")
+    parser.add_option("--batchsize", dest="batch_size", default=50, type="int",
+                      help="Calls per batch request (default: %default)")
+    parser.add_option("--threads", dest="threads", default=4, type="int",
+                      help="Concurrent threads or coroutines (default: %default)")
+    (options, args) = parser.parse_args()
+
+    process, url = start_stub_server(options.size)
+    small = [('getblockcount', ()), ('omni_getbalance', ('mnSKDy53TD88SkmQaJVTLTSUg8apaPJJ3w', 1))]
+    large = [('getrawmempool', ()), ('omni_getorderbook', (3,)), ('listunspent', ())]
+    try:
+        print('%-12s %-18s %10s %10s %10s' % ('mode', 'method', 'calls/s', 'p50 ms', 'p99 ms'))
+        for method, args in small + large:
+            bench_single(url, method, args, options.duration)
+        for method, args in small:
+            bench_batched(url, method, args, options.duration, options.batch_size)
+        for method, args in small:
+            bench_threads(url, method, args, options.duration, options.threads)
+        if sys.version_info >= (3, 5):
+            for method, args in small:
+                bench_async(url, method, args, options.duration, options.threads)
+        bench_decoding(options.size)
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    main()
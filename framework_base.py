@@ -14,15 +14,19 @@ import shutil
 import tempfile
 import traceback
 
-from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException, RPCMetrics
+from bitcoinrpc.cassette import Cassette
 from util import *
 
 
 class BitcoinTestFramework(object):
     # These may be over-ridden by subclasses:
+    num_nodes = 4
+    chain_length = 200
+
     def run_test(self):
         for node in self.nodes:
-            assert_equal(node.getblockcount(), 200)
+            assert_equal(node.getblockcount(), self.chain_length)
         if not self.options.distinctminer:
             assert_equal(self.nodes[0].getbalance(), 100 * 50)
             return
@@ -33,48 +37,65 @@ class BitcoinTestFramework(object):
         pass
 
     def setup_chain(self):
+        if self.cassette is not None and self.cassette.mode == Cassette.REPLAY:
+            print("Replaying RPC calls from " + self.cassette.path)
+            return
         print("Initializing test directory " + self.options.tmpdir)
-        initialize_chain(self.options.bin_bitcoind, self.options.bin_bitcoincli,
-                         self.options.tmpdir, self.options.showstdout)
+        clone_stats = initialize_chain(self.options.bin_bitcoind, self.options.bin_bitcoincli,
+                                       self.options.tmpdir, self.options.showstdout, self.num_nodes,
+                                       self.chain_length, self.options.distinctminer)
+        print(clone_stats)
 
     def setup_network(self, split=False):
-        self.nodes = start_nodes(4, self.options.bin_bitcoind, self.options.bin_bitcoincli,
-                                 self.options.tmpdir, showstdout=self.options.showstdout)
+        self.nodes = start_nodes(self.num_nodes, self.options.bin_bitcoind, self.options.bin_bitcoincli,
+                                 self.options.tmpdir, showstdout=self.options.showstdout,
+                                 metrics=self.rpc_metrics, cassettes=self.cassette_channels)
+        if self.options.rpccache:
+            from framework_rpccache import RPCCache
+            self.nodes = [RPCCache(node) for node in self.nodes]
 
         # Connect the nodes as a "chain".  This allows us
-        # to split the network between nodes 1 and 2 to get
-        # two halves that can work on competing chains.
+        # to split the network in the middle, such as between
+        # nodes 1 and 2, to get two halves that can work on
+        # competing chains.
 
         # If we joined network halves, connect the nodes from the joint
         # on outward.  This ensures that chains are properly reorganised.
-        if not split:
-            connect_nodes_bi(self.nodes, 1, 2)
-            sync_blocks(self.nodes[1:3])
-            sync_mempools(self.nodes[1:3])
+        half = self.num_nodes // 2
+        if not split and half > 0:
+            connect_nodes_bi(self.nodes, half - 1, half)
+            sync_blocks(self.nodes[half - 1:half + 1])
+            sync_mempools(self.nodes[half - 1:half + 1])
 
-        connect_nodes_bi(self.nodes, 0, 1)
-        connect_nodes_bi(self.nodes, 2, 3)
+        for i in range(half - 1, 0, -1):
+            connect_nodes_bi(self.nodes, i - 1, i)
+        for i in range(half, self.num_nodes - 1):
+            connect_nodes_bi(self.nodes, i, i + 1)
         self.is_network_split = split
         self.sync_all()
 
     def split_network(self):
         """
-        Split the network of four nodes into nodes 0/1 and 2/3.
+        Split the network in two halves, such as nodes 0/1 and 2/3 of four nodes.
         """
         assert not self.is_network_split
         stop_nodes(self.nodes)
-        wait_bitcoinds()
+        wait_bitcoinds(self.options.shutdown_timeout)
         self.setup_network(True)
 
     def sync_all(self):
         if self.is_network_split:
-            sync_blocks(self.nodes[:2])
-            sync_blocks(self.nodes[2:])
-            sync_mempools(self.nodes[:2])
-            sync_mempools(self.nodes[2:])
+            half = self.num_nodes // 2
+            sync_blocks(self.nodes[:half])
+            sync_blocks(self.nodes[half:], labels=range(half, self.num_nodes))
+            sync_mempools(self.nodes[:half])
+            sync_mempools(self.nodes[half:], labels=range(half, self.num_nodes))
         else:
             sync_blocks(self.nodes)
             sync_mempools(self.nodes)
+        if self.options.rpccache:
+            for node in self.nodes:
+                node.check_reorg()
 
     def join_network(self):
         """
@@ -82,7 +103,7 @@ class BitcoinTestFramework(object):
         """
         assert self.is_network_split
         stop_nodes(self.nodes)
-        wait_bitcoinds()
+        wait_bitcoinds(self.options.shutdown_timeout)
         self.setup_network(False)
 
     def main(self):
@@ -96,6 +117,8 @@ class BitcoinTestFramework(object):
         parser = optparse.OptionParser(usage="%prog [options]")
         parser.add_option("--clearcache", dest="clearcache", default=False, action="store_true",
                           help="Clear cache on startup (default: %default)")
+        parser.add_option("--prunecache", dest="prunecache", default=False, action="store_true",
+                          help="Remove cached chains of other daemon binaries on startup (default: %default)")
         parser.add_option("--nocleanup", dest="nocleanup", default=False, action="store_true",
                           help="Leave omnicored's and test.* regtest datadir on exit or error (default: %default)")
         parser.add_option("--stdout", dest="showstdout", default=False, action="store_true",
@@ -104,10 +127,28 @@ class BitcoinTestFramework(object):
                           help="The daemon/server (default: %default)")
         parser.add_option("--cli", dest="clibin", default="../../src/omnicore-cli",
                           help="The RPC client (default: %default)")
+        parser.add_option("--distinctminer", dest="distinctminer", default=False, action="store_true",
+                          help="Start from a chain mined by all nodes in turn, instead of only by the first node (default: %default)")
         parser.add_option("--tmpdir", dest="tmpdir", default=tempfile.mkdtemp(prefix="test"),
                           help="Root directory for temporary datadirs")
+        parser.add_option("--ramdisk", dest="ramdisk", default=False, action="store_true",
+                          help="Place the temporary datadirs on a tmpfs, see --ramdiskdir (default: %default)")
+        parser.add_option("--ramdiskdir", dest="ramdisk_dir", default=RAMDISK_DIR,
+                          help="The tmpfs used with --ramdisk (default: %default)")
         parser.add_option("--tracerpc", dest="trace_rpc", default=False, action="store_true",
                           help="Print out all RPC calls as they are made (default: %default)")
+        parser.add_option("--rpccache", dest="rpccache", default=False, action="store_true",
+                          help="Cache RPC results, which no longer change, such as of confirmed transactions (default: %default)")
+        parser.add_option("--rpcmetrics", dest="rpc_metrics", default=False, action="store_true",
+                          help="Print number, latency and size of RPC calls per node and method (default: %default)")
+        parser.add_option("--record", dest="record_dir", default=None,
+                          help="Record all RPC traffic into a cassette file per test in this directory")
+        parser.add_option("--replay", dest="replay_dir", default=None,
+                          help="Replay all RPC traffic from cassette files in this directory, without any nodes")
+        parser.add_option("--shutdowntimeout", dest="shutdown_timeout", default=SHUTDOWN_TIMEOUT, type="int",
+                          help="Seconds to wait for nodes to stop, before they are terminated (default: %default)")
+        parser.add_option("--fastteardown", dest="fastteardown", default=False, action="store_true",
+                          help="Kill nodes instead of stopping them, and remove the datadirs in the background, unless --nocleanup is used (default: %default)")
         parser.add_option("--quiet", dest="quiet", default=False, action="store_true",
                           help="Hide verbose runtime information (default: %default)")
         self.add_options(parser)
@@ -125,21 +166,62 @@ class BitcoinTestFramework(object):
         self.options.bin_bitcoind = os.path.realpath(self.options.daemonbin)
         self.options.bin_bitcoincli = os.path.realpath(self.options.clibin)
 
-        if not os.path.isfile(self.options.bin_bitcoind):
+        self.cassette = None
+        self.cassette_channels = None
+        cassette_name = self.__class__.__name__ + ".cassette.gz"
+        if self.options.replay_dir:
+            self.cassette = Cassette(os.path.join(self.options.replay_dir, cassette_name), Cassette.REPLAY)
+        elif self.options.record_dir:
+            if not os.path.isdir(self.options.record_dir):
+                os.makedirs(self.options.record_dir)
+            self.cassette = Cassette(os.path.join(self.options.record_dir, cassette_name), Cassette.RECORD)
+        if self.cassette is not None:
+            self.cassette_channels = [self.cassette.channel("node" + str(i)) for i in range(self.num_nodes)]
+
+        if not os.path.isfile(self.options.bin_bitcoind) and not self.options.replay_dir:
             print("Invalid daemon file: %s" % (self.options.bin_bitcoind))
             return 1
 
-        if not os.path.isfile(self.options.bin_bitcoincli):
+        if not os.path.isfile(self.options.bin_bitcoincli) and not self.options.replay_dir:
             print("Invalid RPC client file: %s" % (self.options.bin_bitcoincli))
             return 1
 
+        if self.options.ramdisk:
+            if not os.path.isdir(self.options.ramdisk_dir):
+                print("Invalid ramdisk directory: %s" % (self.options.ramdisk_dir))
+                return 1
+            required = self.num_nodes * RAMDISK_BYTES_PER_NODE
+            available = free_space(self.options.ramdisk_dir)
+            if available < required:
+                print("Not enough free space on %s: %.1f MB, but %.1f MB required" % (
+                    self.options.ramdisk_dir, available / 1e6, required / 1e6))
+                return 1
+            # Unless chosen explicitly, the temporary datadirs are moved to the ramdisk
+            if self.options.tmpdir == parser.defaults["tmpdir"]:
+                os.rmdir(self.options.tmpdir)
+                self.options.tmpdir = tempfile.mkdtemp(prefix="test", dir=self.options.ramdisk_dir)
+
         check_json_precision()
+        check_result_stream()
+        allocate_ports(max(self.num_nodes, PORT_RANGE_NODES))
+
+        # Kept over restarts of the nodes
+        self.rpc_metrics = None
+        if self.options.rpc_metrics:
+            self.rpc_metrics = [RPCMetrics() for i in range(self.num_nodes)]
+
+        disk_usage_sampler = None
+        if self.options.ramdisk:
+            disk_usage_sampler = DiskUsageSampler(self.options.tmpdir)
 
         self.success = True
         try:
             if self.options.clearcache and os.path.isdir("cache"):
                 print("Clear cache")
                 shutil.rmtree("cache")
+            if self.options.prunecache and not self.options.replay_dir:
+                for variant in remove_stale_variants("cache", daemon_hash("cache", self.options.bin_bitcoind)):
+                    print("Removed cached chain " + variant)
             if not os.path.isdir(self.options.tmpdir):
                 os.makedirs(self.options.tmpdir)
             self.setup_chain()
@@ -161,11 +243,33 @@ class BitcoinTestFramework(object):
             print("Unexpected exception caught during testing: " + str(e))
             traceback.print_tb(sys.exc_info()[2])
 
-        print("Stopping nodes")
-        stop_nodes(self.nodes)
-        wait_bitcoinds()
+        if self.options.fastteardown and not self.options.nocleanup:
+            # The datadirs are removed anyway, so there is nothing worth flushing
+            print("Killing nodes")
+            kill_bitcoinds()
+            del self.nodes[:]
+        else:
+            print("Stopping nodes")
+            stop_nodes(self.nodes)
+            wait_bitcoinds(self.options.shutdown_timeout)
+
+        if self.cassette is not None and self.cassette.mode == Cassette.RECORD:
+            print("Saving RPC calls to " + self.cassette.path)
+            self.cassette.save()
+
+        if self.rpc_metrics is not None:
+            for i, metrics in enumerate(self.rpc_metrics):
+                print("RPC calls of node %d:" % (i,))
+                print(metrics.report())
+
+        if disk_usage_sampler is not None:
+            disk_usage_sampler.stop()
+            print("Peak disk usage of %s: %.1f MB" % (self.options.tmpdir, disk_usage_sampler.peak / 1e6))
 
-        if not self.options.nocleanup:
+        if not self.options.nocleanup and self.options.fastteardown:
+            print("Cleaning up in the background")
+            remove_tree_in_background(self.options.tmpdir)
+        elif not self.options.nocleanup:
             print("Cleaning up")
             shutil.rmtree(self.options.tmpdir, ignore_errors=True)
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python2
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+# Fast cloning of the chain cache into test directories
+
+import errno
+import fnmatch
+import os
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl to share the data of a file on Btrfs, XFS and other copy-on-write file systems (Linux)
+FICLONE = 0x40049409
+
+# Files, which are never modified once written, and can thus be shared via hardlinks
+IMMUTABLE_FILES = ('*.ldb', '*.sst')
+
+CLONE_THREADS = 4
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Errors, which indicate that a method is not supported for these files
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM,
+                getattr(errno, 'ENOSYS', errno.EINVAL))
+
+
+class CloneStats(object):
+    """Number and size of cloned files per method, and the time it took"""
+
+    METHODS = ('reflink', 'hardlink', 'copy')
+
+    def __init__(self):
+        self.files = dict((method, 0) for method in CloneStats.METHODS)
+        self.bytes = dict((method, 0) for method in CloneStats.METHODS)
+        self.copy_seconds = 0.0
+        self.elapsed = 0.0
+        self.__lock = threading.Lock()
+
+    def add(self, method, size, seconds=0.0):
+        with self.__lock:
+            self.files[method] += 1
+            self.bytes[method] += size
+            if method == 'copy':
+                self.copy_seconds += seconds
+
+    def merge(self, other):
+        for method in CloneStats.METHODS:
+            self.files[method] += other.files[method]
+            self.bytes[method] += other.bytes[method]
+        self.copy_seconds += other.copy_seconds
+        self.elapsed += other.elapsed
+
+    def estimated_savings(self):
+        """Seconds, which copying the shared files would have taken, based on the copies made
+
+        Returns None, if too little was copied for an estimate."""
+        if self.bytes['copy'] < COPY_CHUNK_SIZE or self.copy_seconds <= 0:
+            return None
+        shared = self.bytes['reflink'] + self.bytes['hardlink']
+        return shared / (self.bytes['copy'] / self.copy_seconds)
+
+    def __str__(self):
+        parts = ['%d files (%.1f MB) via %s' % (self.files[method], self.bytes[method] / 1e6, method)
+                 for method in CloneStats.METHODS if self.files[method]]
+        text = 'Cloned %s in %.3f s' % (', '.join(parts) or 'nothing', self.elapsed)
+        savings = self.estimated_savings()
+        if savings is not None:
+            text += ', saved about %.3f s' % (savings,)
+        return text
+
+
+class _Cloner(object):
+    """Clones files, and gives up on methods, once the file system doesn't support them"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.reflink = fcntl is not None and hasattr(fcntl, 'ioctl')
+        self.hardlink = hasattr(os, 'link')
+
+    def clone(self, paths):
+        src, dst = paths
+        size = os.path.getsize(src)
+        if self.hardlink and _is_immutable(src):
+            try:
+                os.link(src, dst)
+                self.stats.add('hardlink', size)
+                return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                self.hardlink = False
+        if self.reflink:
+            try:
+                _reflink(src, dst)
+                shutil.copymode(src, dst)
+                self.stats.add('reflink', size)
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                self.reflink = False
+        started = time.time()
+        _copy(src, dst)
+        shutil.copymode(src, dst)
+        self.stats.add('copy', size, time.time() - started)
+
+
+def _is_immutable(path):
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(name, pattern) for pattern in IMMUTABLE_FILES)
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                fdst.close()
+                os.remove(dst)
+                raise
+
+
+def _copy(src, dst):
+    if not hasattr(os, 'copy_file_range'):
+        # Uses sendfile() on Linux since Python 3.8
+        shutil.copyfile(src, dst)
+        return
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK_SIZE) > 0:
+                    pass
+                return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+    shutil.copyfile(src, dst)
+
+
+def clone_tree(src, dst, threads=CLONE_THREADS):
+    """Clone the directory src to dst, which must not exist yet, and return CloneStats
+
+    Files are shared via reflinks, where supported, and immutable LevelDB
+    tables via hardlinks. All other files are copied, several at once."""
+    started = time.time()
+    stats = CloneStats()
+    files = []
+    for root, dirs, names in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target)
+        shutil.copymode(root, target)
+        files.extend((os.path.join(root, name), os.path.join(target, name)) for name in names)
+
+    _run_parallel(_Cloner(stats).clone, files, threads)
+    stats.elapsed = time.time() - started
+    return stats
+
+
+def _run_parallel(function, items, threads):
+    """Call function for all items from several threads, and raise the first error"""
+    pending = list(reversed(items))
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                item = pending.pop()
+            try:
+                function(item)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    workers = [threading.Thread(target=worker) for i in range(min(threads, len(items)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
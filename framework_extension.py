@@ -10,6 +10,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python
 from bitcoinrpc.authproxy import JSONRPCException
 from framework_base import BitcoinTestFramework
 from framework_info import TestInfo
+from util import NodeGroup, NodeGroupError
 
 
 class MasterTestFramework(BitcoinTestFramework):
@@ -28,11 +29,14 @@ class MasterTestFramework(BitcoinTestFramework):
         NOTE: A balance of zero is assumed, if the property doesn't exist."""
         TestInfo.check_balance(address, expected_balance, propertyid, expected_reserved)
         try:
-            for node in self.nodes:
-                self.check_balance_from(node, address, propertyid, expected_balance, expected_reserved)
+            NodeGroup(self.nodes).apply(self.check_balance_from, address, propertyid, expected_balance,
+                                        expected_reserved)
             TestInfo.OK()
-        except AssertionError as e:
-            TestInfo.Fail('Assertion failed: ' + e.message)
+        except NodeGroupError as e:
+            error = e.primary_error()
+            if not isinstance(error, AssertionError):
+                e.reraise()
+            TestInfo.Fail('Assertion failed: ' + error.message)
 
     def check_balance_from(self, from_node, address, propertyid, expected_balance='0.00000000', expected_reserved=None):
         """Tests whether the address has sufficient balance of a property
@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+# Read-through cache for RPC results, which no longer change
+
+import copy
+from collections import OrderedDict
+
+CACHE_SIZE = 4096
+
+FINAL_TRADE_STATES = ('filled', 'cancelled', 'cancelled part filled')
+
+
+def _raw_getrawtransaction(params, result):
+    """The serialized transaction never changes, but the verbose result has confirmations"""
+    return len(params) < 2 or not params[1]
+
+
+def _confirmed_transaction(params, result):
+    return isinstance(result, dict) and result.get('confirmations', 0) > 0
+
+
+def _final_trade(params, result):
+    return _confirmed_transaction(params, result) and result.get('status') in FINAL_TRADE_STATES
+
+
+def _block_with_successor(params, result):
+    """A serialized block never changes, and the verbose result only once it has a successor"""
+    if len(params) > 1 and not params[1]:
+        return True
+    return isinstance(result, dict) and 'nextblockhash' in result
+
+
+# Per method: whether a result is immutable, given the parameters and result
+IMMUTABLE_RESULTS = {
+    'getrawtransaction': _raw_getrawtransaction,
+    'omni_gettransaction': _confirmed_transaction,
+    'omni_gettrade': _final_trade,
+    'getblock': _block_with_successor,
+}
+
+# Calls, which may change the active chain and thus invalidate the cache
+CHAIN_CHANGING_CALLS = ('invalidateblock', 'reconsiderblock')
+
+
+def _containing_block(result):
+    """The height and hash of the block of a transaction or trade, or of a verbose block itself"""
+    if not isinstance(result, dict):
+        return None
+    if 'block' in result and 'blockhash' in result:
+        return result['block'], result['blockhash']
+    if 'height' in result and 'hash' in result:
+        return result['height'], result['hash']
+    return None
+
+
+class RPCCache(object):
+    """Wraps an AuthServiceProxy and caches results, which no longer change
+
+    Which results are immutable is decided per method by IMMUTABLE_RESULTS.
+    The least recently used results are evicted, once more than max_size
+    results are cached.
+
+    Results are cached with the height and hash of their block, and remain
+    valid as long as that block is part of the chain, which is tested by
+    check_reorg(). It should be called, whenever new blocks may have
+    arrived, and also refreshes the number of confirmations of cached
+    transactions and blocks.
+
+    All other calls and attributes are passed to the proxy."""
+
+    def __init__(self, proxy, max_size=CACHE_SIZE, policies=IMMUTABLE_RESULTS):
+        self.__proxy = proxy
+        self.__max_size = max_size
+        self.__policies = policies
+        self.__entries = OrderedDict()
+        # The highest block seen as (height, hash), and the last known chain height
+        self.__tip = None
+        self.__height = None
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.__proxy, name)
+        if name in self.__policies:
+            return lambda *args: self.__cached_call(name, attr, args)
+        if name in CHAIN_CHANGING_CALLS:
+            def chain_changing_call(*args):
+                self.invalidate()
+                return attr(*args)
+            return chain_changing_call
+        return attr
+
+    def __cached_call(self, name, method, args):
+        key = (name, repr(args))
+        if key in self.__entries:
+            self.hits += 1
+            result, block = self.__entries.pop(key)
+            self.__entries[key] = (result, block)
+            return self.__refreshed(copy.deepcopy(result), block)
+
+        self.misses += 1
+        result = method(*args)
+        if self.__policies[name](args, result):
+            block = _containing_block(result)
+            if block is not None:
+                self.__see_block(block, result.get('confirmations'))
+            self.__entries[key] = (copy.deepcopy(result), block)
+            if len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+        return result
+
+    def __see_block(self, block, confirmations):
+        """Remembers the highest block, and the chain height implied by confirmations"""
+        if self.__tip is None or block[0] > self.__tip[0]:
+            self.__tip = block
+        if confirmations and (self.__height is None or block[0] + confirmations - 1 > self.__height):
+            self.__height = block[0] + confirmations - 1
+
+    def __refreshed(self, result, block):
+        """Updates the number of confirmations, based on the last known chain height"""
+        if not isinstance(result, dict) or 'confirmations' not in result or block is None:
+            return result
+        if self.__height is not None:
+            result['confirmations'] = self.__height - block[0] + 1
+        return result
+
+    def check_reorg(self):
+        """Removes cached results, whose blocks are no longer part of the chain
+
+        Returns whether the previously seen highest block was replaced."""
+        if self.__tip is None:
+            return False
+        tip_height, tip_hash = self.__tip
+        height = self.__proxy.getblockcount()
+        reorged = height < tip_height or self.__proxy.getblockhash(tip_height) != tip_hash
+        if reorged:
+            self.__remove_orphaned(height)
+        self.__height = height
+        self.__tip = (height, self.__proxy.getblockhash(height))
+        return reorged
+
+    def __remove_orphaned(self, height):
+        hashes = {}
+        for key, (result, block) in list(self.__entries.items()):
+            if block is None:
+                continue
+            if block[0] not in hashes:
+                hashes[block[0]] = self.__proxy.getblockhash(block[0]) if block[0] <= height else None
+            if hashes[block[0]] != block[1]:
+                del self.__entries[key]
+
+    def invalidate(self):
+        self.__entries.clear()
+        self.__tip = None
+        self.__height = None
@@ -0,0 +1,229 @@
+"""
+  asyncio counterpart of AuthServiceProxy
+
+  AsyncAuthServiceProxy sends the same JSON-RPC requests as AuthServiceProxy,
+  parses all JSON numbers that look like floats as Decimal and raises
+  JSONRPCException for RPC errors, but calls are coroutines:
+
+      proxies = [AsyncAuthServiceProxy(url) for url in urls]
+      counts = await asyncio.gather(*[p.getblockcount() for p in proxies])
+      info = await proxies[0].getinfo(timeout=5)
+
+  Each proxy keeps a small pool of persistent HTTP/1.1 connections, so several
+  requests to the same server can be in flight at the same time. Calls
+  accept an optional timeout keyword argument, which overrides the default
+  timeout of the proxy for this call only.
+
+  Requires Python 3.5 or later, and only the standard library.
+"""
+
+import asyncio
+import base64
+import decimal
+import json
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+
+from .authproxy import (AuthServiceProxy, EncodeJSON, HTTP_TIMEOUT,
+                        JSONRPCException, USER_AGENT, log)
+
+POOL_SIZE = 4
+
+
+class _AsyncConnection(object):
+    """A persistent HTTP/1.1 connection based on asyncio streams"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, url):
+        port = url.port
+        if port is None:
+            port = 80
+        ssl = url.scheme == 'https' or None
+        reader, writer = await asyncio.open_connection(url.hostname, port, ssl=ssl)
+        return cls(reader, writer)
+
+    async def request(self, header, body):
+        self.writer.write(header + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise JSONRPCException({
+                'code': -342, 'message': 'missing HTTP response from server'})
+        version = status_line.split(b' ', 1)[0]
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('connection', '').lower() == 'close' or version == b'HTTP/1.0':
+            self.reusable = False
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            return await self.__read_chunked()
+        if 'content-length' in headers:
+            return await self.reader.readexactly(int(headers['content-length']))
+        self.reusable = False
+        return await self.reader.read()
+
+    async def __read_chunked(self):
+        chunks = []
+        while True:
+            size_line = await self.reader.readline()
+            size = int(size_line.split(b';', 1)[0], 16)
+            if size == 0:
+                # Skip trailers
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+    def close(self):
+        self.writer.close()
+
+
+class _AsyncConnectionPool(object):
+    """Keeps up to size persistent connections to one server"""
+
+    def __init__(self, url, size):
+        self.size = size
+        self.__url = url
+        self.__idle = []
+        self.__slots = None
+
+    async def acquire(self):
+        if self.__slots is None:
+            # Created lazily, to bind it to the running event loop
+            self.__slots = asyncio.Semaphore(self.size)
+        await self.__slots.acquire()
+        try:
+            while self.__idle:
+                conn = self.__idle.pop()
+                if not conn.reader.at_eof():
+                    return conn
+                conn.close()
+            return await _AsyncConnection.open(self.__url)
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def release(self, conn, reuse=True):
+        if reuse and conn.reusable:
+            self.__idle.append(conn)
+        else:
+            conn.close()
+        self.__slots.release()
+
+    def close(self):
+        idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+
+class AsyncAuthServiceProxy(object):
+
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, pool_size=POOL_SIZE,
+                 connection=None):
+        self.__service_url = service_url
+        self.__service_name = service_name
+        self.__timeout = timeout
+        self.__url = urlparse.urlparse(service_url)
+        (user, passwd) = (self.__url.username, self.__url.password)
+        try:
+            user = user.encode('utf8')
+        except AttributeError:
+            pass
+        try:
+            passwd = passwd.encode('utf8')
+        except AttributeError:
+            pass
+        authpair = user + b':' + passwd
+        self.__auth_header = b'Basic ' + base64.b64encode(authpair)
+
+        if connection is not None:
+            # Callables re-use the connection pool of the original proxy
+            self.__pool = connection
+        else:
+            self.__pool = _AsyncConnectionPool(self.__url, pool_size)
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        if self.__service_name is not None:
+            name = "%s.%s" % (self.__service_name, name)
+        return AsyncAuthServiceProxy(self.__service_url, name, self.__timeout, connection=self.__pool)
+
+    async def __call__(self, *args, timeout=None):
+        call_id = AuthServiceProxy._next_id()
+
+        log.debug("-%s-> %s %s"%(call_id, self.__service_name,
+                                 EncodeJSON(args)))
+        postdata = EncodeJSON({'version': '1.1',
+                               'method': self.__service_name,
+                               'params': args,
+                               'id': call_id})
+        response = await self._request(postdata, timeout)
+        if response['error'] is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        else:
+            return response['result']
+
+    async def _batch(self, rpc_call_list, timeout=None):
+        postdata = EncodeJSON(list(rpc_call_list))
+        log.debug("--> "+postdata)
+        return await self._request(postdata, timeout)
+
+    async def _request(self, postdata, timeout=None):
+        """Send postdata to the server and return the decoded response"""
+        if timeout is None:
+            timeout = self.__timeout
+        return await asyncio.wait_for(self.__request(postdata), timeout)
+
+    async def __request(self, postdata):
+        body = postdata.encode('utf8')
+        header = ('POST %s HTTP/1.1\r\n'
+                  'Host: %s\r\n'
+                  'User-Agent: %s\r\n'
+                  'Authorization: %s\r\n'
+                  'Content-type: application/json\r\n'
+                  'Content-Length: %d\r\n\r\n') % (
+            self.__url.path or '/', self.__url.hostname, USER_AGENT,
+            self.__auth_header.decode('ascii'), len(body))
+
+        conn = await self.__pool.acquire()
+        try:
+            responsedata = await conn.request(header.encode('latin-1'), body)
+        except BaseException:
+            # Includes cancellation by a timeout, which leaves the connection in an unknown state
+            self.__pool.release(conn, reuse=False)
+            raise
+        self.__pool.release(conn)
+
+        responsedata = responsedata.decode('utf8')
+        response = json.loads(responsedata, parse_float=decimal.Decimal)
+        if "error" in response and response["error"] is None:
+            log.debug("<-%s- %s"%(response["id"], EncodeJSON(response["result"])))
+        else:
+            log.debug("<-- "+responsedata)
+        return response
+
+    def close(self):
+        """Close all idle connections of the proxy"""
+        self.__pool.close()
@@ -11,7 +11,12 @@
   - sends proper, incrementing 'id'
   - sends Basic HTTP authentication headers
   - parses all JSON numbers that look like floats as Decimal
+  - sends Decimals as exact fixed-point numbers
   - uses standard Python json lib
+  - decodes huge array results incrementally via stream()
+  - can record and replay all traffic, see cassette.py
+  - optionally keeps a pool of connections, so a proxy can be shared
+    across threads
 
   Previous copyright, from python-jsonrpc/jsonrpc/proxy.py:
 
@@ -39,9 +44,15 @@ try:
 except ImportError:
     import httplib
 import base64
+import codecs
 import decimal
+import io
 import json
 import logging
+import numbers
+import socket
+import threading
+import time
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -51,6 +62,13 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float('inf'))
+
+_timer = getattr(time, 'perf_counter', time.time)
+
 log = logging.getLogger("BitcoinRPC")
 
 class JSONRPCException(Exception):
@@ -61,20 +79,213 @@ class JSONRPCException(Exception):
 
 def EncodeDecimal(o):
     if isinstance(o, decimal.Decimal):
-        return round(o, 8)
+        # round() of a Decimal returns a Decimal on Python 3
+        return float(round(o, 8))
     raise TypeError(repr(o) + " is not JSON serializable")
 
+
+_COIN_PLACES = decimal.Decimal('0.00000001')
+
+
+def _decimal_text(o):
+    """Returns a Decimal as fixed-point number, rounded to 8 decimal places, if it has more"""
+    if not o.is_finite():
+        raise ValueError(repr(o) + " is not JSON compliant")
+    text = str(o)
+    point = text.find('.')
+    if 'E' in text or (point >= 0 and len(text) - point > 9):
+        # Exponent notation or more than 8 decimal places; the default
+        # precision of 28 digits isn't enough for huge values
+        context = decimal.Context(prec=max(o.adjusted(), 0) + 10)
+        text = '{0:f}'.format(o.quantize(_COIN_PLACES, rounding=decimal.ROUND_HALF_EVEN, context=context))
+    return text
+
+
+# Decimals are first written as strings enclosed by control characters,
+# and are then unquoted. Each marker adds _MARK_ESCAPES escaped NULs, so if
+# there are any others, a string contained NULs, and the slow path is taken.
+_DECIMAL_MARK = '\x00\x00'
+_DECIMAL_START = '"\\u0000\\u0000'
+_DECIMAL_END = '\\u0000\\u0000"'
+_MARK_ESCAPES = 4
+
+
+def _encode_exact(o):
+    """Serializes o without markers, as JSONEncoder would with its default separators"""
+    if isinstance(o, decimal.Decimal):
+        return _decimal_text(o)
+    if isinstance(o, dict):
+        items = []
+        for key, value in o.items():
+            if isinstance(key, numbers.Number) or key is None:
+                # Converted to strings, like JSONEncoder does
+                key = json.dumps(key)
+            items.append(json.dumps(key) + ': ' + _encode_exact(value))
+        return '{' + ', '.join(items) + '}'
+    if isinstance(o, (list, tuple)):
+        return '[' + ', '.join(_encode_exact(value) for value in o) + ']'
+    return json.dumps(o)
+
+
+def EncodeJSON(o):
+    """Serializes o like json.dumps(o, default=EncodeDecimal), but Decimals are
+    written as exact fixed-point numbers, without conversion to float"""
+    marked = [0]
+
+    def mark_decimal(value):
+        if isinstance(value, decimal.Decimal):
+            marked[0] += 1
+            return _DECIMAL_MARK + _decimal_text(value) + _DECIMAL_MARK
+        raise TypeError(repr(value) + " is not JSON serializable")
+
+    encoded = json.JSONEncoder(default=mark_decimal).encode(o)
+    if not marked[0]:
+        return encoded
+    if encoded.count('\\u0000') != _MARK_ESCAPES * marked[0]:
+        return _encode_exact(o)
+    return encoded.replace(_DECIMAL_START, '').replace(_DECIMAL_END, '')
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """Sends small requests without delay
+
+    Python 3 writes the headers and body of a request separately, and
+    Nagle's algorithm may otherwise hold back the body until the server
+    acknowledges the headers, which is delayed by up to 40 ms."""
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _new_connection(url, timeout):
+    port = url.port
+    if port is None:
+        port = 80
+    if url.scheme == 'https':
+        return _HTTPSConnection(url.hostname, port, timeout=timeout)
+    return _HTTPConnection(url.hostname, port, timeout=timeout)
+
+
+class ConnectionPool(object):
+    """Keeps up to size persistent HTTP connections to one server
+
+    A connection is handed out to one thread at a time, and threads block,
+    if all connections are in use. Connections are opened lazily and kept
+    alive for reuse, unless a request on them failed."""
+
+    def __init__(self, url, size, timeout=HTTP_TIMEOUT):
+        if size < 1:
+            raise ValueError('pool size must be at least 1')
+        self.size = size
+        self.__url = url
+        self.__timeout = timeout
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        self.__slots.acquire()
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+        try:
+            return _new_connection(self.__url, self.__timeout)
+        except:
+            self.__slots.release()
+            raise
+
+    def release(self, conn, reuse=True):
+        if reuse:
+            with self.__lock:
+                self.__idle.append(conn)
+        else:
+            conn.close()
+        self.__slots.release()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+
+class RPCMetrics(object):
+    """Records the number of calls, latencies and payload sizes per method
+
+    An instance can be passed to an AuthServiceProxy, which then records
+    every call, including the decoding of the response. Batch requests
+    are recorded as method "batch"."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__methods = {}
+
+    def record(self, method, seconds, request_bytes, response_bytes):
+        with self.__lock:
+            stats = self.__methods.get(method)
+            if stats is None:
+                stats = self.__methods[method] = {
+                    'calls': 0, 'seconds': 0.0, 'request_bytes': 0, 'response_bytes': 0,
+                    'histogram': [0] * len(LATENCY_BUCKETS)}
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['request_bytes'] += request_bytes
+            stats['response_bytes'] += response_bytes
+            for bucket, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    stats['histogram'][bucket] += 1
+                    break
+
+    def summary(self):
+        """Return a copy of the statistics per method"""
+        with self.__lock:
+            return dict((method, dict(stats, histogram=list(stats['histogram'])))
+                        for method, stats in self.__methods.items())
+
+    @staticmethod
+    def percentile(stats, fraction):
+        """Return the upper bound of the latency bucket, which contains the given fraction of calls"""
+        remaining = fraction * stats['calls']
+        for bucket, count in enumerate(stats['histogram']):
+            remaining -= count
+            if remaining <= 0:
+                return LATENCY_BUCKETS[bucket]
+        return LATENCY_BUCKETS[-1]
+
+    def report(self):
+        """Return a table of all methods, ordered by total time spent"""
+        lines = ['%-28s %7s %9s %9s %9s %9s %11s %11s' % (
+            'method', 'calls', 'total s', 'mean ms', 'p50 ms', 'p99 ms', 'sent B', 'received B')]
+        summary = self.summary()
+        for method in sorted(summary, key=lambda m: summary[m]['seconds'], reverse=True):
+            stats = summary[method]
+            lines.append('%-28s %7d %9.3f %9.3f %9s %9s %11d %11d' % (
+                method, stats['calls'], stats['seconds'], 1000.0 * stats['seconds'] / stats['calls'],
+                '<=%g' % (1000 * self.percentile(stats, 0.5)), '<=%g' % (1000 * self.percentile(stats, 0.99)),
+                stats['request_bytes'], stats['response_bytes']))
+        return '\n'.join(lines)
+
+
 class AuthServiceProxy(object):
     __id_count = 0
+    __id_lock = threading.Lock()
 
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None):
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, pool_size=None,
+                 metrics=None, cassette=None):
         self.__service_url = service_url
         self.__service_name = service_name
+        self.__metrics = metrics
+        self.__cassette = cassette
+        self.__replaying = cassette is not None and cassette.replaying
         self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
         (user, passwd) = (self.__url.username, self.__url.password)
         try:
             user = user.encode('utf8')
@@ -86,42 +297,60 @@ class AuthServiceProxy(object):
             pass
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
+        self.__headers = {'Host': self.__url.hostname,
+                          'User-Agent': USER_AGENT,
+                          'Authorization': self.__auth_header,
+                          'Content-type': 'application/json'}
+        # Requests are built from a template, and only the params and id vary
+        self.__envelope = '{"version": "1.1", "method": %s, "params": ' % (EncodeJSON(service_name),)
 
-        if connection:
+        self.__conn = None
+        self.__pool = None
+        if isinstance(connection, ConnectionPool):
+            # Callables re-use the connection pool of the original proxy
+            self.__pool = connection
+        elif connection:
             # Callables re-use the connection of the original proxy
             self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  None, None, False,
-                                                  timeout)
+        elif self.__replaying:
+            # Responses are replayed from the cassette, without any server
+            pass
+        elif pool_size is not None:
+            # Pooled mode, which allows the proxy to be shared across threads
+            self.__pool = ConnectionPool(self.__url, pool_size, timeout)
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 False, timeout)
+            self.__conn = _new_connection(self.__url, timeout)
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
             # Python internal stuff
             raise AttributeError
         if self.__service_name is not None:
-            name = "%s.%s" % (self.__service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+            service_name = "%s.%s" % (self.__service_name, name)
+        else:
+            service_name = name
+        proxy = AuthServiceProxy(self.__service_url, service_name, connection=self.__pool or self.__conn,
+                                 metrics=self.__metrics, cassette=self.__cassette)
+        # Later lookups of the same method find the proxy without calling __getattr__
+        self.__dict__[name] = proxy
+        return proxy
+
+    @staticmethod
+    def _next_id():
+        with AuthServiceProxy.__id_lock:
+            AuthServiceProxy.__id_count += 1
+            return AuthServiceProxy.__id_count
+
+    def __encode_call(self, args):
+        call_id = AuthServiceProxy._next_id()
+        params = EncodeJSON(args)
+
+        log.debug("-%s-> %s %s", call_id, self.__service_name, params)
+        return '%s%s, "id": %d}' % (self.__envelope, params, call_id)
 
     def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
-
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self.__service_name,
-                                 json.dumps(args, default=EncodeDecimal)))
-        postdata = json.dumps({'version': '1.1',
-                               'method': self.__service_name,
-                               'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal)
-        self.__conn.request('POST', self.__url.path, postdata,
-                            {'Host': self.__url.hostname,
-                             'User-Agent': USER_AGENT,
-                             'Authorization': self.__auth_header,
-                             'Content-type': 'application/json'})
-
-        response = self._get_response()
+        postdata = self.__encode_call(args)
+        response = self._request(postdata, self.__service_name)
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -130,27 +359,338 @@ class AuthServiceProxy(object):
         else:
             return response['result']
 
+    def stream(self, *args):
+        """Call the method and iterate over the result, while it is received
+
+        The elements of an array result, or the (name, value) pairs of an
+        object result, are decoded and yielded one after another, so huge
+        results are never held in memory as a whole. Other results are
+        yielded as single item.
+
+        Unless the proxy is pooled, the iteration must be finished before
+        the next call is made."""
+        postdata = self.__encode_call(args)
+        if self.__metrics is not None:
+            started = _timer()
+        conn = None
+        finished = False
+        result_stream = None
+        try:
+            if self.__replaying:
+                http_response = io.BytesIO(self.__cassette.play(postdata)[0])
+            else:
+                conn = self.__acquire()
+                self.__send(conn, postdata)
+                http_response = conn.getresponse()
+                if http_response is None:
+                    raise JSONRPCException({
+                        'code': -342, 'message': 'missing HTTP response from server'})
+                if self.__cassette is not None:
+                    http_response = _RecordingReader(http_response)
+            result_stream = _ResultStream(http_response)
+            for item in result_stream.items():
+                yield item
+            finished = True
+            if self.__cassette is not None and not self.__replaying:
+                self.__cassette.record(postdata, http_response.data())
+        finally:
+            # An unfinished response leaves the connection in an unknown state
+            if conn is not None:
+                self.__release(conn, reuse=finished)
+            if self.__metrics is not None and result_stream is not None:
+                self.__metrics.record(self.__service_name, _timer() - started,
+                                      len(postdata), result_stream.size)
+
+    def batch(self):
+        """Return an RPCBatch, which queues calls and sends them in one request"""
+        return RPCBatch(self)
+
+    def _batch_call(self, calls):
+        """Send a list of (method, params) in one request, return results in order
+
+        Calls which failed are represented by JSONRPCException instances."""
+        rpc_call_list = []
+        for (method, params) in calls:
+            if self.__service_name is not None:
+                method = "%s.%s" % (self.__service_name, method)
+            rpc_call_list.append({'version': '1.1',
+                                  'method': method,
+                                  'params': params,
+                                  'id': AuthServiceProxy._next_id()})
+        if not rpc_call_list:
+            return []
+
+        response = self._batch(rpc_call_list)
+        if not isinstance(response, list):
+            # The whole batch was rejected
+            raise JSONRPCException(response.get('error') or {
+                'code': -344, 'message': 'invalid JSON-RPC batch response'})
+
+        responses_by_id = dict((item.get('id'), item) for item in response)
+        results = []
+        for rpc_call in rpc_call_list:
+            item = responses_by_id.get(rpc_call['id'])
+            if item is None:
+                results.append(JSONRPCException({
+                    'code': -343, 'message': 'missing JSON-RPC result'}))
+            elif item.get('error') is not None:
+                results.append(JSONRPCException(item['error']))
+            elif 'result' not in item:
+                results.append(JSONRPCException({
+                    'code': -343, 'message': 'missing JSON-RPC result'}))
+            else:
+                results.append(item['result'])
+        return results
+
     def _batch(self, rpc_call_list):
-        postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal)
+        postdata = EncodeJSON(list(rpc_call_list))
         log.debug("--> "+postdata)
-        self.__conn.request('POST', self.__url.path, postdata,
-                            {'Host': self.__url.hostname,
-                             'User-Agent': USER_AGENT,
-                             'Authorization': self.__auth_header,
-                             'Content-type': 'application/json'})
+        return self._request(postdata, 'batch')
+
+    def _request(self, postdata, method=None):
+        """Send postdata to the server and return the decoded response"""
+        if self.__metrics is not None:
+            started = _timer()
+        if self.__replaying:
+            responsedata, recorded_ids = self.__cassette.play(postdata)
+        else:
+            conn = self.__acquire()
+            try:
+                self.__send(conn, postdata)
+                responsedata = self.__read_response(conn)
+            except:
+                self.__release(conn, reuse=False)
+                raise
+            self.__release(conn)
+            if self.__cassette is not None:
+                self.__cassette.record(postdata, responsedata)
+        response = self.__decode_response(responsedata)
+        if self.__replaying and isinstance(response, list):
+            # Batch results are matched by the ids of the current request
+            for item in response:
+                item['id'] = recorded_ids.get(item.get('id'), item.get('id'))
+        if self.__metrics is not None:
+            self.__metrics.record(method, _timer() - started, len(postdata), len(responsedata))
+        return response
+
+    def __acquire(self):
+        if self.__pool is None:
+            return self.__conn
+        return self.__pool.acquire()
+
+    def __release(self, conn, reuse=True):
+        if self.__pool is not None:
+            self.__pool.release(conn, reuse)
+        elif not reuse:
+            # The connection is reopened by the next request
+            conn.close()
+
+    def __send(self, conn, postdata):
+        if not isinstance(postdata, bytes):
+            postdata = postdata.encode('utf8')
+        conn.request('POST', self.__url.path, postdata, self.__headers)
 
-        return self._get_response()
+    def _get_response(self, conn=None):
+        if conn is None:
+            conn = self.__conn
+        return self.__decode_response(self.__read_response(conn))
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+    def __read_response(self, conn):
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
+        return http_response.read()
 
-        responsedata = http_response.read().decode('utf8')
+    def __decode_response(self, responsedata):
+        responsedata = responsedata.decode('utf8')
         response = json.loads(responsedata, parse_float=decimal.Decimal)
+        if not log.isEnabledFor(logging.DEBUG):
+            return response
         if "error" in response and response["error"] is None:
-            log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal)))
+            log.debug("<-%s- %s"%(response["id"], EncodeJSON(response["result"])))
         else:
             log.debug("<-- "+responsedata)
         return response
+
+
+class _RecordingReader(object):
+    """Keeps a copy of everything read from the response"""
+
+    def __init__(self, fp):
+        self.__fp = fp
+        self.__chunks = []
+
+    def read(self, size):
+        chunk = self.__fp.read(size)
+        self.__chunks.append(chunk)
+        return chunk
+
+    def data(self):
+        return b''.join(self.__chunks)
+
+
+class _ResultStream(object):
+    """Incrementally decodes a JSON-RPC response, which is read in chunks
+
+    The members of the response are decoded as usual, except the result,
+    whose elements are yielded by items() as soon as they are complete.
+    Numbers that look like floats are parsed as Decimal."""
+
+    WHITESPACE = ' \t\n\r'
+    DELIMITERS = WHITESPACE + ',:]}'
+
+    def __init__(self, fp, chunk_size=STREAM_CHUNK_SIZE):
+        self.__fp = fp
+        self.__chunk_size = chunk_size
+        self.__text = codecs.getincrementaldecoder('utf8')()
+        self.__decoder = json.JSONDecoder(parse_float=decimal.Decimal)
+        self.__buf = ''
+        self.__pos = 0
+        self.__eof = False
+        self.response = {}
+        self.size = 0
+
+    def items(self):
+        streamed = False
+        self.__expect('{')
+        if self.__peek() == '}':
+            self.__pos += 1
+        else:
+            while True:
+                key = self.__value()
+                self.__expect(':')
+                if key == 'result' and self.__peek() in ('[', '{'):
+                    for item in self.__elements():
+                        yield item
+                    streamed = True
+                else:
+                    self.response[key] = self.__value()
+                if self.__next_separator('}'):
+                    break
+
+        if self.response.get('error') is not None:
+            raise JSONRPCException(self.response['error'])
+        elif streamed:
+            return
+        elif 'result' not in self.response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        else:
+            yield self.response['result']
+
+    def __elements(self):
+        opening = self.__buf[self.__pos]
+        closing = ']' if opening == '[' else '}'
+        self.__pos += 1
+        if self.__peek() == closing:
+            self.__pos += 1
+            return
+        while True:
+            if opening == '{':
+                name = self.__value()
+                self.__expect(':')
+                yield (name, self.__value())
+            else:
+                yield self.__value()
+            if self.__next_separator(closing):
+                return
+
+    def __next_separator(self, closing):
+        """Consumes the next separator and returns whether it closes the container"""
+        char = self.__peek()
+        self.__pos += 1
+        if char == closing:
+            return True
+        if char != ',':
+            raise ValueError('malformed JSON-RPC response at "%s"' % char)
+        return False
+
+    def __fill(self, size=0):
+        data = self.__fp.read(max(size, self.__chunk_size))
+        self.size += len(data)
+        if not data:
+            self.__eof = True
+        self.__buf = self.__buf[self.__pos:] + self.__text.decode(data, final=self.__eof)
+        self.__pos = 0
+
+    def __peek(self):
+        while True:
+            while self.__pos < len(self.__buf) and self.__buf[self.__pos] in self.WHITESPACE:
+                self.__pos += 1
+            if self.__pos < len(self.__buf):
+                return self.__buf[self.__pos]
+            if self.__eof:
+                raise ValueError('truncated JSON-RPC response')
+            self.__fill()
+
+    def __expect(self, char):
+        if self.__peek() != char:
+            raise ValueError('malformed JSON-RPC response, expected "%s"' % char)
+        self.__pos += 1
+
+    def __value(self):
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buf, self.__pos)
+            except ValueError:
+                if self.__eof:
+                    raise
+                # Values are decoded again from their start, so the buffered
+                # part is doubled each time, to decode each byte O(1) times
+                self.__fill(len(self.__buf) - self.__pos)
+                continue
+            if not self.__eof and (end == len(self.__buf) or self.__buf[end] not in self.DELIMITERS):
+                # A number may continue in the next chunk
+                self.__fill(len(self.__buf) - self.__pos)
+                continue
+            self.__pos = end
+            return value
+
+
+class RPCBatch(object):
+    """Collects RPC calls and sends them as one JSON-RPC batch request
+
+    Calls are queued by calling methods on the batch object, which return
+    the index of the call. The batch is sent by execute(), or when leaving
+    the with-block, and results are returned in the order of the calls:
+
+        with proxy.batch() as batch:
+            batch.getblockcount()
+            batch.omni_getbalance(address, 1)
+        blockcount, balance = batch.results
+
+    A call which failed is represented by a JSONRPCException instance in
+    place of its result, so one failing call doesn't hide the others."""
+
+    def __init__(self, proxy):
+        self.__proxy = proxy
+        self.__calls = []
+        self.results = None
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        def queue_call(*args):
+            self.__calls.append((name, args))
+            return len(self.__calls) - 1
+        return queue_call
+
+    def __len__(self):
+        return len(self.__calls)
+
+    def execute(self):
+        """Send all queued calls and return their results"""
+        calls, self.__calls = self.__calls, []
+        self.results = self.__proxy._batch_call(calls)
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+        return False
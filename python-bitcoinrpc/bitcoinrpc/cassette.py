@@ -0,0 +1,163 @@
+"""
+  Record and replay of JSON-RPC traffic
+
+  A Cassette records the requests and raw responses exchanged by
+  AuthServiceProxy objects, and stores them in a gzip compressed file with
+  one JSON object per line. In replay mode, the same calls are answered from
+  the file, without any server:
+
+      cassette = Cassette('run.cassette.gz', Cassette.RECORD)
+      proxy = AuthServiceProxy(url, cassette=cassette.channel('node0'))
+      ...
+      cassette.save()
+
+      cassette = Cassette('run.cassette.gz', Cassette.REPLAY)
+      proxy = AuthServiceProxy(url, cassette=cassette.channel('node0'))
+
+  Each channel, usually one per server, is replayed independently. A call is
+  answered by the next unused response, which was recorded for the same
+  method and parameters. Only for ENVIRONMENT_DEPENDENT_METHODS, whose
+  parameters depend on the environment, such as ports, the next unused
+  response of the same method is used otherwise. Once all responses of a
+  call are used, the last one is repeated for READ_ONLY_POLLING_METHODS,
+  which keeps polling loops working. Any other call, which wasn't recorded,
+  raises a CassetteError, so changed tests don't pass with stale responses.
+"""
+
+import gzip
+import json
+import threading
+from collections import deque
+
+
+# Methods, which are replayed regardless of their parameters
+ENVIRONMENT_DEPENDENT_METHODS = ('addnode',)
+
+# Methods, whose last response is repeated, as polling loops call them a varying number of times
+READ_ONLY_POLLING_METHODS = ('getbestblockhash', 'getblockcount', 'getmempoolinfo', 'getpeerinfo',
+                             'getrawmempool')
+
+
+class CassetteError(LookupError):
+    pass
+
+
+def _parse_request(postdata):
+    """Return the request without ids as key, the method(s) and the ids"""
+    # Numbers are only compared, so their exact type doesn't matter
+    request = json.loads(postdata, parse_float=str)
+    calls = request if isinstance(request, list) else [request]
+    ids = [call.pop('id', None) for call in calls]
+    methods = ' '.join(str(call.get('method')) for call in calls)
+    return json.dumps(request, sort_keys=True), methods, ids
+
+
+def _only(methods, allowed):
+    """Whether all methods of a call or batch are allowed"""
+    return all(method in allowed for method in methods.split(' '))
+
+
+class _Recording(object):
+
+    def __init__(self, request, methods, ids, response):
+        self.request = request
+        self.methods = methods
+        self.ids = ids
+        self.response = response
+        self.used = False
+
+
+class CassetteChannel(object):
+    """The recordings of one server, which are passed to an AuthServiceProxy"""
+
+    def __init__(self, cassette, name):
+        self.name = name
+        self.replaying = cassette.mode == Cassette.REPLAY
+        self.__cassette = cassette
+        self.__by_request = {}
+        self.__by_method = {}
+        self.__last_played = {}
+
+    def _load(self, recording):
+        self.__by_request.setdefault(recording.request, deque()).append(recording)
+        self.__by_method.setdefault(recording.methods, deque()).append(recording)
+
+    def record(self, postdata, responsedata):
+        request, methods, ids = _parse_request(postdata)
+        self.__cassette._append(self.name, _Recording(request, methods, ids, responsedata))
+
+    def play(self, postdata):
+        """Return the recorded response and a mapping of recorded to requested ids"""
+        request, methods, ids = _parse_request(postdata)
+        with self.__cassette.lock:
+            recording = self.__next_unused(self.__by_request.get(request))
+            if recording is None and _only(methods, ENVIRONMENT_DEPENDENT_METHODS):
+                recording = self.__next_unused(self.__by_method.get(methods))
+            if recording is None and _only(methods, READ_ONLY_POLLING_METHODS):
+                recording = self.__last_played.get(request)
+            if recording is None:
+                raise CassetteError('no recorded response for %s on %s' % (request, self.name))
+            recording.used = True
+            self.__last_played[request] = recording
+        return recording.response, dict(zip(recording.ids, ids))
+
+    @staticmethod
+    def __next_unused(recordings):
+        while recordings:
+            if not recordings[0].used:
+                return recordings[0]
+            recordings.popleft()
+        return None
+
+
+class Cassette(object):
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, path, mode):
+        if mode not in (Cassette.RECORD, Cassette.REPLAY):
+            raise ValueError('invalid cassette mode: %s' % (mode,))
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.__channels = {}
+        self.__recordings = []
+        if mode == Cassette.REPLAY:
+            self.__load()
+
+    def channel(self, name):
+        with self.lock:
+            if name not in self.__channels:
+                self.__channels[name] = CassetteChannel(self, name)
+            return self.__channels[name]
+
+    def _append(self, name, recording):
+        with self.lock:
+            self.__recordings.append((name, recording))
+
+    def __load(self):
+        f = gzip.open(self.path, 'rb')
+        try:
+            for line in f:
+                entry = json.loads(line.decode('utf8'))
+                recording = _Recording(entry['request'], entry['methods'], entry['ids'],
+                                       entry['response'].encode('utf8'))
+                self.channel(entry['channel'])._load(recording)
+        finally:
+            f.close()
+
+    def save(self):
+        """Write all recordings to the cassette file"""
+        with self.lock:
+            recordings = list(self.__recordings)
+        f = gzip.open(self.path, 'wb')
+        try:
+            for name, recording in recordings:
+                line = json.dumps({'channel': name,
+                                   'request': recording.request,
+                                   'methods': recording.methods,
+                                   'ids': recording.ids,
+                                   'response': recording.response.decode('utf8')})
+                f.write(line.encode('utf8') + b'\n')
+        finally:
+            f.close()
@@ -11,24 +11,267 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-bitcoinrpc"))
 
 from decimal import Decimal, ROUND_DOWN
+import atexit
+import errno
+import getpass
+import glob
+import hashlib
+import io
 import json
 import random
 import shutil
+import socket
 import subprocess
+import tempfile
+import threading
 import time
 import re
+from multiprocessing.pool import ThreadPool
 
-from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from bitcoinrpc.authproxy import AuthServiceProxy, EncodeJSON, JSONRPCException, _ResultStream
+from framework_clone import CloneStats, clone_tree
 from util import *
 
 RPC_TIMEOUT = 120
+RPC_STARTUP_TIMEOUT = 60
+
+# Seconds to wait for omnicored to exit after stop, and then after SIGTERM
+SHUTDOWN_TIMEOUT = 60
+TERMINATE_TIMEOUT = 10
+
+# Seconds to wait for nodes to sync, and the first and longest delay between polls
+SYNC_TIMEOUT = 60
+SYNC_POLL_INITIAL = 0.002
+SYNC_POLL_MAXIMUM = 0.1
+
+# Number of blocks per batch request, when the other nodes import the chain of node 0
+BOOTSTRAP_BATCH_SIZE = 50
+
+# Seconds between checks of the files written by -blocknotify and -walletnotify
+NOTIFY_POLL_INTERVAL = 0.002
+
+# RPC errors of servers, which are up, but not yet ready
+RPC_IN_WARMUP = -28
+RPC_NO_RESPONSE = -342
+
+# Number of threads shared by all NodeGroups
+FANOUT_THREADS = 8
+
+# Default tmpfs for --ramdisk, the space to reserve per node, and the seconds between usage samples
+RAMDISK_DIR = "/dev/shm"
+RAMDISK_BYTES_PER_NODE = 64 * 1024 * 1024
+DISK_USAGE_INTERVAL = 0.25
 
 def p2p_port(n):
-    return 11000 + n + os.getpid() % 999
+    base, num_nodes = _get_port_allocation(n)
+    return base + n
 
 
 def rpc_port(n):
-    return 12000 + n + os.getpid() % 999
+    base, num_nodes = _get_port_allocation(n)
+    return base + num_nodes + n
+
+
+# Ports are allocated per process, as one range for the P2P and RPC ports of all nodes
+PORT_MIN = 11000
+PORT_MAX = 32767  # Below the ephemeral port range of most systems
+PORT_RANGE_NODES = 16
+
+
+def _user_name():
+    try:
+        name = getpass.getuser()
+    except Exception:
+        name = str(os.getuid()) if hasattr(os, "getuid") else "unknown"
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+# Per user, as the temporary directory may be shared, but not writable by others
+PORT_REGISTRY = os.path.join(tempfile.gettempdir(), "omnicore-rpc-tests-ports-%s.json" % (_user_name(),))
+
+_port_allocation = None
+
+
+def allocate_ports(num_nodes=PORT_RANGE_NODES):
+    """
+    Reserve P2P and RPC ports for num_nodes nodes, and return the first port
+
+    The ranges of all test processes on this machine are kept in
+    PORT_REGISTRY, which is guarded by a lock file, and ranges of processes,
+    which no longer exist, are reclaimed. Ports, which can't be bound, are
+    skipped. The range is released, when the process exits.
+    """
+    global _port_allocation
+    if _port_allocation is not None:
+        if _port_allocation[1] < num_nodes:
+            raise ValueError("Ports of %d nodes are already allocated" % (_port_allocation[1],))
+        return _port_allocation[0]
+    size = 2 * num_nodes
+    with _PortRegistry() as registry:
+        taken = [(base, base + count) for pid, (base, count) in registry.ranges.items()]
+        for base in range(PORT_MIN, PORT_MAX - size + 1, size):
+            if any(base < end and start < base + size for start, end in taken):
+                continue
+            if all(_port_is_free(port) for port in range(base, base + size)):
+                registry.ranges[os.getpid()] = (base, size)
+                break
+        else:
+            raise RuntimeError("No free range of %d ports between %d and %d" % (size, PORT_MIN, PORT_MAX))
+    _port_allocation = (base, num_nodes)
+    atexit.register(_release_ports)
+    return base
+
+
+def _get_port_allocation(n):
+    if _port_allocation is None:
+        allocate_ports()
+    if n >= _port_allocation[1]:
+        raise ValueError("Node %d exceeds the %d nodes with allocated ports" % (n, _port_allocation[1]))
+    return _port_allocation
+
+
+def _release_ports():
+    with _PortRegistry() as registry:
+        registry.ranges.pop(os.getpid(), None)
+
+
+def _port_is_free(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("127.0.0.1", port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def _pid_exists(pid):
+    if os.name == "nt":
+        # os.kill() would terminate the process, so ask for its exit code instead
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return kernel32.GetLastError() == ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+# Seconds between attempts to lock a file on Windows, which has no blocking lock
+FILE_LOCK_POLL_INTERVAL = 0.1
+
+# Windows API constants used by _pid_exists()
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+ERROR_ACCESS_DENIED = 5
+STILL_ACTIVE = 259
+
+
+def replace_file(src, dst):
+    """
+    Rename src to dst, replacing dst, if it exists
+
+    os.rename() does so atomically on POSIX, but fails on Windows, if dst
+    exists, and Python 2 has no os.replace(), so dst is removed first there.
+    """
+    if os.name == "nt":
+        try:
+            os.remove(dst)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    os.rename(src, dst)
+
+
+class FileLock(object):
+    """
+    Exclusive lock of a file, shared by all processes on this machine
+
+        with FileLock(path):
+            ...
+
+    Blocks until the lock is acquired. The file is created, if needed, and
+    must never be removed, as others may already wait for it. With shared,
+    several processes may hold the lock at once, but none exclusively;
+    Windows has no shared locks, so they are exclusive there.
+    """
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.__file = None
+
+    def __enter__(self):
+        self.__file = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self.__file.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        else:
+            # LK_LOCK gives up after 10 seconds, but a cache build takes longer
+            while True:
+                self.__file.seek(0)
+                try:
+                    msvcrt.locking(self.__file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except (IOError, OSError):
+                    time.sleep(FILE_LOCK_POLL_INTERVAL)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.__file.seek(0)
+            msvcrt.locking(self.__file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.__file.close()
+        self.__file = None
+        return False
+
+
+class _PortRegistry(object):
+    """
+    Exclusive access to the port ranges of all test processes, as pid -> (first port, count)
+    """
+    def __enter__(self):
+        self.__lock = FileLock(PORT_REGISTRY + ".lock")
+        self.__lock.__enter__()
+        self.ranges = {}
+        try:
+            with open(PORT_REGISTRY) as f:
+                for pid, allocated in json.load(f).items():
+                    if _pid_exists(int(pid)):
+                        self.ranges[int(pid)] = tuple(allocated)
+        except (IOError, ValueError):
+            pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                with open(PORT_REGISTRY + ".tmp", "w") as f:
+                    json.dump(dict((str(pid), allocated) for pid, allocated in self.ranges.items()), f)
+                replace_file(PORT_REGISTRY + ".tmp", PORT_REGISTRY)
+        finally:
+            self.__lock.__exit__(exc_type, exc_value, traceback)
 
 
 def check_json_precision():
@@ -40,36 +283,341 @@ def check_json_precision():
     if satoshis != 2000000000000003:
         raise RuntimeError("JSON encode/decode loses precision")
 
+    # The maximum amount of divisible tokens, which isn't exact as float, next to the marker of Decimals
+    params = [Decimal("92233720368.54775807"), "\x00\x00memo\x00\x00"]
+    if json.loads(EncodeJSON(params), parse_float=Decimal) != params:
+        raise RuntimeError("JSON encoding of RPC parameters loses precision")
+
+
+# Responses, whose results are decoded incrementally by AuthServiceProxy.stream()
+STREAM_CHECK_RESPONSES = [
+    b'{"result": [{"txid": "ab", "amount": 92233720368.54775807, "vout": 0, "spendable": true},'
+    b' {"address": "m\xc3\xa4\xe2\x82\xac\xf0\x9f\x92\xb0", "label": "quote \\" and \\\\ and \\u00e4",'
+    b' "fee": -0.00001000, "tags": [], "nested": {"a": [1, 2.5e-3, null, false]}}, "", 0, -1.0],'
+    b' "error": null, "id": 1}',
+    b'{"id": 2, "error": null, "result": {"balance": "250.00000000", "reserved": 0.00000001, "empty": {}}}',
+    b'{"result":[ ],"error":null,"id":3}',
+]
+
 
-def sync_blocks(rpc_connections):
+def check_result_stream():
     """
-    Wait until everybody has the same block count
+    Make sure incrementally decoded results match json.loads(), at any chunk size
+    """
+    for response in STREAM_CHECK_RESPONSES:
+        expected = json.loads(response.decode("utf8"), parse_float=Decimal)["result"]
+        for chunk_size in (1, 2, 3, 7, 64):
+            items = list(_ResultStream(io.BytesIO(response), chunk_size).items())
+            streamed = dict(items) if isinstance(expected, dict) else items
+            if streamed != expected:
+                raise RuntimeError("Streamed JSON decoding differs in chunks of %d bytes" % (chunk_size,))
+
+
+def backoff_delays(initial=0.01, maximum=0.25, factor=2):
     """
+    Yield delays for polling loops, which start short and grow up to maximum
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+def wait_for_rpc(url, process=None, timeout=RPC_STARTUP_TIMEOUT):
+    """
+    Wait until the RPC server at url answers calls
+
+    Refused connections and RPC errors during warm-up are retried with a
+    short backoff, until the deadline passes. If process is given, and it
+    exits in the meantime, this fails immediately.
+    """
+    proxy = AuthServiceProxy(url, None, RPC_TIMEOUT)
+    deadline = time.time() + timeout
+    delays = backoff_delays()
     while True:
-        counts = [x.getblockcount() for x in rpc_connections]
-        if counts == [counts[0]] * len(counts):
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("omnicored exited with code %d before RPC at %s was ready"
+                               % (process.returncode, url))
+        try:
+            proxy.getblockcount()
             return
-        time.sleep(1)
+        except JSONRPCException as e:
+            if e.error['code'] not in (RPC_IN_WARMUP, RPC_NO_RESPONSE):
+                raise
+        except (socket.error, httplib.HTTPException):
+            pass
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError("Timeout after %d seconds waiting for RPC at %s" % (timeout, url))
+        time.sleep(min(next(delays), remaining))
+
+
+class NodeGroupError(Exception):
+    """
+    Raised by NodeGroup, if a call failed on at least one node
+
+    Per node, results holds the result, or None if it failed, and errors the
+    exception, or None if it succeeded. Nodes are labeled by their number in
+    messages, and exc_infos holds the sys.exc_info() of each failure.
+    """
+    def __init__(self, results, errors, labels=None, exc_infos=None):
+        if labels is None:
+            labels = range(len(errors))
+        failures = ["node %s: %s" % (label, _describe_error(error)) for label, error in zip(labels, errors)
+                    if error is not None]
+        Exception.__init__(self, "Call failed on " + "; ".join(failures))
+        self.results = results
+        self.errors = errors
+        self.labels = list(labels)
+        self.exc_infos = exc_infos or [None for error in errors]
+
+    def first_error(self):
+        return next(error for error in self.errors if error is not None)
+
+    def primary_error(self):
+        """The first error, which is not a failed assertion, if any, or else the first one"""
+        return self.errors[self.__primary_index()]
+
+    def reraise(self):
+        """Raise the primary error again, with the traceback of the node's thread"""
+        index = self.__primary_index()
+        if self.exc_infos[index] is None:
+            raise self.errors[index]
+        _reraise(self.exc_infos[index])
+
+    def __primary_index(self):
+        failed = [i for i, error in enumerate(self.errors) if error is not None]
+        return next((i for i in failed if not isinstance(self.errors[i], AssertionError)), failed[0])
+
+
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    # The three-argument raise is a syntax error on Python 3
+    exec("def _reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n")
+
+
+def _describe_error(error):
+    if isinstance(error, JSONRPCException):
+        return "%s (%s)" % (error.error['message'], error.error['code'])
+    return "%s: %s" % (type(error).__name__, error)
+
+
+_fanout_pool = None
+_fanout_lock = threading.Lock()
+_fanout_state = threading.local()
+
+
+def _mark_fanout_worker():
+    _fanout_state.worker = True
+
+
+def _fanout(function, items):
+    """
+    Apply function to all items at once, and return the results in order
+    """
+    global _fanout_pool
+    # Calls from within a worker run sequentially, so nested use can't exhaust the pool
+    if len(items) < 2 or getattr(_fanout_state, 'worker', False):
+        return [function(item) for item in items]
+    with _fanout_lock:
+        if _fanout_pool is None:
+            _fanout_pool = ThreadPool(FANOUT_THREADS, _mark_fanout_worker)
+    return _fanout_pool.map(function, items, chunksize=1)
+
+
+class NodeGroup(object):
+    """
+    Runs the same call on several nodes at once
+
+        counts = NodeGroup(nodes).call('getblockcount')
+
+    Results are returned in node order. If the call fails on any node, a
+    NodeGroupError with the results and exceptions per node is raised, where
+    nodes are labeled by labels, or else by their position. Each node is only
+    used by one thread at a time, so plain AuthServiceProxy objects can be used.
+    """
+    def __init__(self, nodes, labels=None):
+        self.nodes = list(nodes)
+        self.labels = list(labels) if labels is not None else list(range(len(self.nodes)))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def call(self, name, *args):
+        """Call the RPC method name with args on all nodes"""
+        return self.apply(lambda node: getattr(node, name)(*args))
+
+    def apply(self, function, *args):
+        """Call function(node, *args) for all nodes"""
+        def outcome(node):
+            try:
+                return function(node, *args), None
+            except Exception:
+                return None, sys.exc_info()
+
+        outcomes = _fanout(outcome, self.nodes)
+        results = [result for result, exc_info in outcomes]
+        exc_infos = [exc_info for result, exc_info in outcomes]
+        if any(exc_info is not None for exc_info in exc_infos):
+            errors = [exc_info[1] if exc_info is not None else None for exc_info in exc_infos]
+            raise NodeGroupError(results, errors, self.labels, exc_infos)
+        return results
+
 
+def notify_filename(datadir, kind):
+    """
+    The file, to which the -blocknotify or -walletnotify command of a node appends
+    """
+    return os.path.join(os.path.abspath(datadir), kind + "notify.log")
 
-def sync_mempools(rpc_connections):
+
+class NotificationWatcher(object):
+    """
+    Follows the files written by -blocknotify and -walletnotify of all nodes
+
+    A background thread checks the files for new lines every few
+    milliseconds, records the hashes with the time of arrival, and wakes up
+    all threads in wait(). Checking the size of local files is much cheaper
+    than RPC calls, so the sync helpers use wait() instead of sleeping, and
+    poll the nodes as soon as anything happened.
+    """
+    KINDS = ("block", "wallet")
+
+    def __init__(self, interval=NOTIFY_POLL_INTERVAL):
+        self.interval = interval
+        self.__condition = threading.Condition()
+        self.__files = {}
+        self.__arrivals = {}
+        self.__thread = None
+        self.__stopped = False
+
+    def watch(self, n, datadir):
+        """Follow the notifications of node n, ignoring those written before"""
+        with self.__condition:
+            for kind in NotificationWatcher.KINDS:
+                path = notify_filename(datadir, kind)
+                offset = os.path.getsize(path) if os.path.isfile(path) else 0
+                self.__files[(n, kind)] = [path, offset]
+                self.__arrivals.setdefault((n, kind), [])
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+                atexit.register(self.stop)
+
+    def arrivals(self, n, kind="block"):
+        """Return (hash, time) tuples of all notifications of node n"""
+        with self.__condition:
+            return list(self.__arrivals.get((n, kind), []))
+
+    def wait(self, timeout):
+        """Wait until the next notification of any node, or timeout seconds passed"""
+        with self.__condition:
+            self.__condition.wait(timeout)
+
+    def stop(self):
+        """Stop the background thread"""
+        self.__stopped = True
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __run(self):
+        while not self.__stopped:
+            time.sleep(self.interval)
+            with self.__condition:
+                if self.__check():
+                    self.__condition.notify_all()
+
+    def __check(self):
+        arrived = False
+        for key, entry in self.__files.items():
+            path, offset = entry
+            try:
+                if os.path.getsize(path) <= offset:
+                    continue
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except (IOError, OSError):
+                continue
+            # Only complete lines; the rest is read again next time
+            complete = data[:data.rfind(b"\n") + 1]
+            entry[1] = offset + len(complete)
+            now = time.time()
+            for line in complete.splitlines():
+                if line.strip():
+                    self.__arrivals[key].append((line.strip().decode("ascii"), now))
+                    arrived = True
+        return arrived
+
+
+node_notifications = NotificationWatcher()
+
+
+def _sync_call(group, name):
+    # Failed RPC calls surface as they would without the NodeGroup
+    try:
+        return group.call(name)
+    except NodeGroupError as e:
+        e.reraise()
+
+
+def sync_blocks(rpc_connections, timeout=SYNC_TIMEOUT, labels=None):
+    """
+    Wait until everybody has the same best block, and return the seconds waited
+
+    Polling starts after a few milliseconds, and backs off, while the nodes
+    are still catching up, but any block or wallet notification of a node
+    triggers the next poll immediately. The nodes are labeled by labels in
+    errors, such as their node numbers.
+    """
+    group = NodeGroup(rpc_connections, labels)
+    started = time.time()
+    delays = backoff_delays(SYNC_POLL_INITIAL, SYNC_POLL_MAXIMUM)
+    while True:
+        hashes = _sync_call(group, 'getbestblockhash')
+        if hashes == [hashes[0]] * len(hashes):
+            return time.time() - started
+        if time.time() - started >= timeout:
+            raise AssertionError("Block sync timed out after %g seconds: %s" % (timeout, hashes))
+        node_notifications.wait(next(delays))
+
+
+def sync_mempools(rpc_connections, timeout=SYNC_TIMEOUT, labels=None):
     """
     Wait until everybody has the same transactions in their memory
-    pools
+    pools, and return the seconds waited
+
+    The number of transactions and their size are compared first, and only
+    if they match on all nodes, the transactions themselves. The nodes are
+    labeled by labels in errors.
     """
+    group = NodeGroup(rpc_connections, labels)
+    started = time.time()
+    delays = backoff_delays(SYNC_POLL_INITIAL, SYNC_POLL_MAXIMUM)
     while True:
-        pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        for i in range(1, len(rpc_connections)):
-            if set(rpc_connections[i].getrawmempool()) == pool:
-                num_match += 1
-        if num_match == len(rpc_connections):
-            return
-        time.sleep(1)
+        summaries = [(info['size'], info['bytes']) for info in _sync_call(group, 'getmempoolinfo')]
+        if summaries == [summaries[0]] * len(summaries):
+            if summaries[0][0] == 0:
+                return time.time() - started
+            pools = [set(pool) for pool in _sync_call(group, 'getrawmempool')]
+            if all(pool == pools[0] for pool in pools):
+                return time.time() - started
+        if time.time() - started >= timeout:
+            raise AssertionError("Mempool sync timed out after %g seconds: %s" % (timeout, summaries))
+        node_notifications.wait(next(delays))
 
 
 bitcoind_processes = {}
 
+# Per node: seconds from the start of waiting until omnicored exited, and how it was stopped
+shutdown_times = {}
+
 
 def initialize_datadir(path, n):
     datadir = os.path.join(path, "node" + str(n))
@@ -82,102 +630,226 @@ def initialize_datadir(path, n):
         f.write("port=" + str(p2p_port(n)) + "\n")
         f.write("rpcport=" + str(rpc_port(n)) + "\n")
         f.write("txindex=1\n")
+        for kind in NotificationWatcher.KINDS:
+            f.write("%snotify=echo %%s >> \"%s\"\n" % (kind, notify_filename(datadir, kind)))
     return datadir
 
 
-def initialize_chain(bin_bitcoind, bin_bitcoincli, test_dir, showstdout=False):
-    """
-    Create (or copy from cache) a 200-block-long chain and
-    4 wallets.
-    """
-    if not os.path.isdir(os.path.join("cache", "node0")):
-        devnull = None
-        if not showstdout:
-            devnull = open(os.devnull, "w+")
-        # Create cache directories, run omnicoreds:
-        for i in range(4):
-            datadir = initialize_datadir("cache", i)
-            args = [bin_bitcoind, "-keypool=1", "-datadir=" + datadir, "-discover=0"]
-            if i > 0:
-                args.append("-connect=127.0.0.1:" + str(p2p_port(0)))
-            bitcoind_processes[i] = subprocess.Popen(args, stdout=devnull)
-            subprocess.check_call([bin_bitcoincli, "-datadir=" + datadir,
-                                   "-rpcwait", "getblockcount"], stdout=devnull)
-        if devnull is not None:
-            devnull.close()
-        rpcs = []
-        for i in range(4):
-            url = "http://rt:rt@127.0.0.1:%d" % (rpc_port(i),)
-            try:
-                rpcs.append(AuthServiceProxy(url, None, RPC_TIMEOUT))
-            except:
-                sys.stderr.write("Error connecting to " + url + "\n")
-                sys.exit(1)
-
-        # Create a 200-block-long chain and node 1 gets all
-        rpcs[0].setgenerate(True, 200)
-        sync_blocks(rpcs)
-
-        # Shut them down, and clean up cache directories:
-        stop_nodes(rpcs)
-        wait_bitcoinds()
-        for i in range(4):
-            if not os.path.isdir("cache"):
-                continue
-            if os.path.isfile(log_filename("cache", i, "db.log")):
-                os.remove(log_filename("cache", i, "db.log"))
-            if os.path.isfile(log_filename("cache", i, "debug.log")):
-                os.remove(log_filename("cache", i, "debug.log"))
-            if os.path.isfile(log_filename("cache", i, "omnicore.log")):
-                os.remove(log_filename("cache", i, "omnicore.log"))
-            if os.path.isfile(log_filename("cache", i, "peers.dat")):
-                os.remove(log_filename("cache", i, "peers.dat"))
-            if os.path.isfile(log_filename("cache", i, "fee_estimates.dat")):
-                os.remove(log_filename("cache", i, "fee_estimates.dat"))
-            if os.path.isdir(log_filename("cache", i, "MP_persist")):
-                shutil.rmtree(log_filename("cache", i, "MP_persist"))
-            if os.path.isdir(log_filename("cache", i, "MP_spinfo")):
-                shutil.rmtree(log_filename("cache", i, "MP_spinfo"))
-            if os.path.isdir(log_filename("cache", i, "MP_tradelist")):
-                shutil.rmtree(log_filename("cache", i, "MP_tradelist"))
-            if os.path.isdir(log_filename("cache", i, "MP_txlist")):
-                shutil.rmtree(log_filename("cache", i, "MP_txlist"))
-            if os.path.isdir(log_filename("cache", i, "MP_stolist")):
-                shutil.rmtree(log_filename("cache", i, "MP_stolist"))
-
-    for i in range(4):
-        from_dir = os.path.join("cache", "node" + str(i))
-        to_dir = os.path.join(test_dir, "node" + str(i))
-        shutil.copytree(from_dir, to_dir)
-        initialize_datadir(test_dir, i)  # Overwrite port/rpcport in bitcoin.conf
-
-
-def _rpchost_to_args(rpchost):
-    """
-    Convert optional IP:port spec to rpcconnect/rpcport args
-    """
-    if rpchost is None:
-        return []
-
-    match = re.match('(\[[0-9a-fA-f:]+\]|[^:]+)(?::([0-9]+))?$', rpchost)
-    if not match:
-        raise ValueError('Invalid RPC host spec ' + rpchost)
-
-    rpcconnect = match.group(1)
-    rpcport = match.group(2)
-
-    if rpcconnect.startswith('['):  # remove IPv6 [...] wrapping
-        rpcconnect = rpcconnect[1:-1]
-
-    rv = ['-rpcconnect=' + rpcconnect]
-    if rpcport:
-        rv += ['-rpcport=' + rpcport]
-    return rv
-
-
-def start_node(i, bin_bitcoind, bin_bitcoincli, path, extra_args=None, rpchost=None, showstdout=False):
+_daemon_hashes = {}
+
+
+def daemon_fingerprint(bin_bitcoind):
     """
-    Start a omnicored and return RPC connection to it
+    Return the SHA256 hash of the daemon binary, and its size and modification time
+    """
+    stat = os.stat(bin_bitcoind)
+    key = (os.path.realpath(bin_bitcoind), stat.st_size, stat.st_mtime)
+    if key not in _daemon_hashes:
+        digest = hashlib.sha256()
+        with open(bin_bitcoind, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        _daemon_hashes[key] = digest.hexdigest()
+    return {"path": key[0], "sha256": _daemon_hashes[key], "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def daemon_hash(cache_root, bin_bitcoind):
+    """
+    Return the SHA256 hash of the daemon binary
+
+    The hash is remembered in cache_root/daemon.json, and the binary is only
+    hashed again, if its path, size or modification time changed.
+    """
+    path = os.path.join(cache_root, "daemon.json")
+    stat = os.stat(bin_bitcoind)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if (cached["path"], cached["size"], cached["mtime"]) == (
+                os.path.realpath(bin_bitcoind), stat.st_size, stat.st_mtime):
+            return cached["sha256"]
+    except (IOError, ValueError, KeyError):
+        pass
+    fingerprint = daemon_fingerprint(bin_bitcoind)
+    if not os.path.isdir(cache_root):
+        os.makedirs(cache_root)
+    with open("%s.tmp-%d" % (path, os.getpid()), "w") as f:
+        json.dump(fingerprint, f)
+    replace_file("%s.tmp-%d" % (path, os.getpid()), path)
+    return fingerprint["sha256"]
+
+
+def cache_variant(num_nodes, chain_length, distinct_miner, daemon_sha256):
+    """
+    The name of the cache directory of a chain, such as nodes4-blocks200-node0-<hash>
+    """
+    miner = "distinct" if distinct_miner else "node0"
+    return "nodes%d-blocks%d-%s-%s" % (num_nodes, chain_length, miner, daemon_sha256[:16])
+
+
+_CACHE_VARIANT_RE = re.compile(r"^(nodes\d+-blocks\d+-(?:node0|distinct)-([0-9a-f]{16}))(?:\.tmp-\d+)?$")
+
+
+def remove_stale_variants(cache_root, daemon_sha256):
+    """
+    Remove the cached chains of all other daemon binaries
+
+    Each variant is removed while holding its lock exclusively, so other
+    runners complete building or copying it first. Returns the names of the
+    removed variants.
+    """
+    stale = set()
+    for name in os.listdir(cache_root) if os.path.isdir(cache_root) else []:
+        match = _CACHE_VARIANT_RE.match(name)
+        if match and match.group(2) != daemon_sha256[:16]:
+            stale.add(match.group(1))
+    for variant in sorted(stale):
+        path = os.path.join(cache_root, variant)
+        with FileLock(path + ".lock"):
+            for removed_path in glob.glob(path + ".tmp-*") + [path]:
+                shutil.rmtree(removed_path, ignore_errors=True)
+    return sorted(stale)
+
+
+def export_blocks(node, first_height, last_height, batch_size=BOOTSTRAP_BATCH_SIZE):
+    """
+    Return the serialized blocks from first_height to last_height of a node
+    """
+    blocks = []
+    for start in range(first_height, last_height + 1, batch_size):
+        heights = range(start, min(start + batch_size, last_height + 1))
+        with node.batch() as batch:
+            for height in heights:
+                batch.getblockhash(height)
+        with node.batch() as hex_batch:
+            for block_hash in _batch_results(batch):
+                hex_batch.getblock(block_hash, False)
+        blocks.extend(_batch_results(hex_batch))
+    return blocks
+
+
+def import_blocks(node, blocks, batch_size=BOOTSTRAP_BATCH_SIZE):
+    """
+    Submit serialized blocks, in order, to a node
+    """
+    for start in range(0, len(blocks), batch_size):
+        with node.batch() as batch:
+            for block in blocks[start:start + batch_size]:
+                batch.submitblock(block)
+        for result in _batch_results(batch):
+            # None, if the block was accepted
+            if result is not None and result != "duplicate":
+                raise RuntimeError("Block rejected by submitblock: %s" % (result,))
+
+
+def _batch_results(batch):
+    for result in batch.results:
+        if isinstance(result, JSONRPCException):
+            raise result
+    return batch.results
+
+
+def _build_chain_cache(cache_dir, bin_bitcoind, bin_bitcoincli, showstdout, num_nodes, chain_length,
+                       distinct_miner):
+    # Create cache directories, run omnicoreds:
+    for i in range(num_nodes):
+        initialize_datadir(cache_dir, i)
+
+    if distinct_miner:
+        # All nodes mine in turn
+        extra_args = [None] + [["-connect=127.0.0.1:" + str(p2p_port(0))] for i in range(1, num_nodes)]
+        rpcs = start_nodes(num_nodes, bin_bitcoind, bin_bitcoincli, cache_dir, extra_args, showstdout=showstdout)
+        blocks_per_turn = chain_length // (2 * num_nodes)
+        for turn in range(2):
+            for rpc in rpcs:
+                rpc.setgenerate(True, blocks_per_turn)
+                sync_blocks(rpcs)
+        remaining_blocks = chain_length - 2 * num_nodes * blocks_per_turn
+        if remaining_blocks > 0:
+            rpcs[0].setgenerate(True, remaining_blocks)
+    else:
+        # Node 0 mines the chain alone, and the other nodes only import it, without any connections
+        rpcs = start_nodes(num_nodes, bin_bitcoind, bin_bitcoincli, cache_dir,
+                           showstdout=showstdout, indices=[0])
+        rpcs[0].setgenerate(True, chain_length)
+        blocks = export_blocks(rpcs[0], 1, chain_length)
+        rpcs += start_nodes(num_nodes, bin_bitcoind, bin_bitcoincli, cache_dir,
+                            showstdout=showstdout, indices=range(1, num_nodes))
+        NodeGroup(rpcs[1:], range(1, num_nodes)).apply(import_blocks, blocks)
+    sync_blocks(rpcs)
+
+    # Shut them down, and clean up cache directories:
+    stop_nodes(rpcs)
+    wait_bitcoinds()
+    for i in range(num_nodes):
+        if not os.path.isdir(cache_dir):
+            continue
+        if os.path.isfile(log_filename(cache_dir, i, "db.log")):
+            os.remove(log_filename(cache_dir, i, "db.log"))
+        if os.path.isfile(log_filename(cache_dir, i, "debug.log")):
+            os.remove(log_filename(cache_dir, i, "debug.log"))
+        if os.path.isfile(log_filename(cache_dir, i, "omnicore.log")):
+            os.remove(log_filename(cache_dir, i, "omnicore.log"))
+        if os.path.isfile(log_filename(cache_dir, i, "peers.dat")):
+            os.remove(log_filename(cache_dir, i, "peers.dat"))
+        if os.path.isfile(log_filename(cache_dir, i, "fee_estimates.dat")):
+            os.remove(log_filename(cache_dir, i, "fee_estimates.dat"))
+        for kind in NotificationWatcher.KINDS:
+            if os.path.isfile(notify_filename(os.path.join(cache_dir, "node" + str(i)), kind)):
+                os.remove(notify_filename(os.path.join(cache_dir, "node" + str(i)), kind))
+    # The Omni Core state in MP_* was flushed on shutdown, and is kept,
+    # as the daemon is part of the cache key
+
+
+def initialize_chain(bin_bitcoind, bin_bitcoincli, test_dir, showstdout=False, num_nodes=4,
+                     chain_length=200, distinct_miner=False):
+    """
+    Create (or copy from cache) a chain of chain_length blocks
+    and num_nodes wallets.
+
+    Each combination of the number of nodes, chain length, miners and daemon
+    binary is cached in its own directory below cache/. Per default node 0
+    mines all blocks alone, and the other nodes are only started afterwards,
+    to import the blocks via submitblock. With distinct_miner, all nodes mine
+    the same number of blocks, in two rounds, so every node has mature
+    coinbases.
+
+    Concurrent runners share the cache: it is built in a temporary
+    directory, while holding a lock file, and then renamed into place, so
+    other runners wait for it, instead of building it at the same time.
+    The cache is copied while holding the lock shared, so it can't be
+    removed by remove_stale_variants() in the meantime.
+
+    Returns the CloneStats of copying the cache.
+    """
+    daemon_sha256 = daemon_hash("cache", bin_bitcoind)
+    cache_dir = os.path.join("cache", cache_variant(num_nodes, chain_length, distinct_miner, daemon_sha256))
+    while True:
+        with FileLock(cache_dir + ".lock", shared=True):
+            if os.path.isdir(os.path.join(cache_dir, "node0")):
+                stats = CloneStats()
+                for i in range(num_nodes):
+                    from_dir = os.path.join(cache_dir, "node" + str(i))
+                    to_dir = os.path.join(test_dir, "node" + str(i))
+                    stats.merge(clone_tree(from_dir, to_dir))
+                    initialize_datadir(test_dir, i)  # Overwrite port/rpcport in bitcoin.conf
+                return stats
+
+        with FileLock(cache_dir + ".lock"):
+            # Another runner may have built it, while waiting for the lock
+            if not os.path.isdir(os.path.join(cache_dir, "node0")):
+                # Left over by runners, which failed
+                for path in glob.glob(cache_dir + ".tmp-*") + [cache_dir]:
+                    shutil.rmtree(path, ignore_errors=True)
+                build_dir = "%s.tmp-%d" % (cache_dir, os.getpid())
+                _build_chain_cache(build_dir, bin_bitcoind, bin_bitcoincli, showstdout, num_nodes,
+                                   chain_length, distinct_miner)
+                os.rename(build_dir, cache_dir)
+
+
+def _launch_node(i, bin_bitcoind, path, extra_args=None, showstdout=False):
+    """
+    Start a omnicored process, without waiting for its RPC server
     """
     datadir = os.path.join(path, "node" + str(i))
     args = [bin_bitcoind, "-datadir=" + datadir, "-keypool=1", "-discover=0"]
@@ -186,48 +858,241 @@ def start_node(i, bin_bitcoind, bin_bitcoincli, path, extra_args=None, rpchost=N
     devnull = None
     if not showstdout:
         devnull = open(os.devnull, "w+")
+    node_notifications.watch(i, datadir)
     bitcoind_processes[i] = subprocess.Popen(args, stdout=devnull)
-    subprocess.check_call([bin_bitcoincli, "-datadir=" + datadir] +
-                          _rpchost_to_args(rpchost) +
-                          ["-rpcwait", "getblockcount"], stdout=devnull)
     if devnull is not None:
         devnull.close()
-    url = "http://rt:rt@%s:%d" % (rpchost or '127.0.0.1', rpc_port(i))
-    proxy = AuthServiceProxy(url, None, RPC_TIMEOUT)
+    return bitcoind_processes[i]
+
+
+def _node_url(i, rpchost=None):
+    return "http://rt:rt@%s:%d" % (rpchost or '127.0.0.1', rpc_port(i))
+
+
+def _node_proxy(url, metrics=None, cassette=None):
+    proxy = AuthServiceProxy(url, None, RPC_TIMEOUT, metrics=metrics, cassette=cassette)
     proxy.url = url  # store URL on proxy for info
     return proxy
 
 
-def start_nodes(num_nodes, bin_bitcoind, bin_bitcoincli, path, extra_args=None, rpchost=None, showstdout=False):
+def start_node(i, bin_bitcoind, bin_bitcoincli, path, extra_args=None, rpchost=None, showstdout=False,
+               metrics=None, cassette=None):
+    """
+    Start a omnicored and return RPC connection to it
+
+    The RPC client bin_bitcoincli is no longer used to wait for the server,
+    and only kept for compatibility.
+    If metrics is an RPCMetrics object, all RPC calls are recorded.
+    If cassette is a CassetteChannel, all RPC traffic is recorded, or
+    replayed without starting omnicored at all.
+    """
+    url = _node_url(i, rpchost)
+    if cassette is None or not cassette.replaying:
+        process = _launch_node(i, bin_bitcoind, path, extra_args, showstdout)
+        wait_for_rpc(url, process)
+    return _node_proxy(url, metrics, cassette)
+
+
+def start_nodes(num_nodes, bin_bitcoind, bin_bitcoincli, path, extra_args=None, rpchost=None, showstdout=False,
+                metrics=None, cassettes=None, indices=None):
     """
     Start multiple omnicoreds, return RPC connections to them
+
+    All nodes are launched at once, and then awaited together. If any node
+    fails to start, all nodes started here are killed, and a NodeGroupError
+    with the error per node is raised.
+    Only the nodes in indices are started, if given, but extra_args, metrics
+    and cassettes are still indexed by node number.
     """
+    if indices is None:
+        indices = range(num_nodes)
     if extra_args is None:
         extra_args = [None for i in range(num_nodes)]
-    return [start_node(i, bin_bitcoind, bin_bitcoincli, path, extra_args[i], rpchost, showstdout) for i in range(num_nodes)]
+    if metrics is None:
+        metrics = [None for i in range(num_nodes)]
+    if cassettes is None:
+        cassettes = [None for i in range(num_nodes)]
+    urls = [_node_url(i, rpchost) for i in range(num_nodes)]
+    launched = [i for i in indices if cassettes[i] is None or not cassettes[i].replaying]
+    try:
+        for i in launched:
+            _launch_node(i, bin_bitcoind, path, extra_args[i], showstdout)
+        NodeGroup(launched, launched).apply(lambda i: wait_for_rpc(urls[i], bitcoind_processes[i]))
+    except BaseException:
+        for i in launched:
+            process = bitcoind_processes.pop(i, None)
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+        raise
+    return [_node_proxy(urls[i], metrics[i], cassettes[i]) for i in indices]
 
 
 def log_filename(path, n_node, logname):
     return os.path.join(path, "node" + str(n_node), "regtest", logname)
 
 
-def stop_node(node, i):
+def stop_node(node, i, timeout=SHUTDOWN_TIMEOUT):
     node.stop()
-    bitcoind_processes[i].wait()
-    del bitcoind_processes[i]
+    _wait_processes({i: bitcoind_processes.pop(i)}, timeout)
 
 
 def stop_nodes(nodes):
-    for i in range(len(nodes)):
-        nodes[i].stop()
+    """
+    Send stop to all nodes at once
+
+    Nodes, which can't be reached, are left to wait_bitcoinds().
+    """
+    try:
+        NodeGroup(nodes).call('stop')
+    except NodeGroupError as e:
+        sys.stderr.write("Failed to stop nodes: %s\n" % (e,))
     del nodes[:]  # Emptying array closes connections as a side effect
 
 
-def wait_bitcoinds():
-    # Wait for all omnicoreds to cleanly exit
-    for bitcoind in bitcoind_processes.values():
-        bitcoind.wait()
+def wait_bitcoinds(timeout=SHUTDOWN_TIMEOUT):
+    """
+    Wait for all omnicoreds to exit, and return the per node shutdown times
+
+    Processes, which are still running after timeout seconds, are sent
+    SIGTERM, and SIGKILL, if they don't exit within TERMINATE_TIMEOUT either.
+    """
+    processes = dict(bitcoind_processes)
+    bitcoind_processes.clear()
+    return _wait_processes(processes, timeout)
+
+
+def kill_bitcoinds():
+    """
+    Kill all omnicoreds without a clean shutdown, and return the per node shutdown times
+
+    Wallets, block databases and Omni Core state are not flushed, so this is
+    only suitable for datadirs, which are discarded afterwards.
+    """
+    started = time.time()
+    processes = dict(bitcoind_processes)
     bitcoind_processes.clear()
+    times = {}
+    for i, process in processes.items():
+        if process.poll() is None:
+            process.kill()
+    for i, process in processes.items():
+        process.wait()
+        times[i] = (time.time() - started, "killed")
+    shutdown_times.update(times)
+    return times
+
+
+def remove_tree_in_background(path):
+    """
+    Remove the directory path in a background thread, and return the thread
+
+    The directory is moved into a new sibling first, so path is free
+    immediately. If it can't be moved, it's removed right away instead, so
+    a later user of path never races with the removal. The thread isn't a
+    daemon, so the removal completes before the interpreter exits.
+    """
+    if not os.path.isdir(path):
+        return None
+    path = path.rstrip(os.sep)
+    removing_dir = None
+    try:
+        removing_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + ".removing-",
+                                        dir=os.path.dirname(path) or ".")
+        os.rename(path, os.path.join(removing_dir, os.path.basename(path)))
+    except OSError:
+        if removing_dir is not None:
+            shutil.rmtree(removing_dir, True)
+        shutil.rmtree(path, True)
+        return None
+    thread = threading.Thread(target=shutil.rmtree, args=(removing_dir, True))
+    thread.start()
+    return thread
+
+
+def free_space(path):
+    """
+    Return the number of bytes available to this user on the file system of path
+    """
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+def disk_usage(path):
+    """
+    Return the number of bytes allocated by all files below path
+    """
+    total = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            try:
+                stats = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue  # Removed in the meantime
+            blocks = getattr(stats, "st_blocks", None)
+            total += stats.st_size if blocks is None else blocks * 512
+    return total
+
+
+class DiskUsageSampler(object):
+    """
+    Samples the disk usage of a directory in a background thread, to report the peak
+
+        sampler = DiskUsageSampler(path)
+        ...
+        sampler.stop()
+        print(sampler.peak)
+    """
+    def __init__(self, path, interval=DISK_USAGE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background thread, after a last sample"""
+        self.__stopped.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def __run(self):
+        while True:
+            self.peak = max(self.peak, disk_usage(self.path))
+            if self.__stopped.wait(self.interval):
+                self.peak = max(self.peak, disk_usage(self.path))
+                return
+
+
+def _wait_processes(processes, timeout):
+    started = time.time()
+    pending = dict(processes)
+    times = {}
+    for how, grace in (("stopped", timeout), ("terminated", TERMINATE_TIMEOUT), ("killed", None)):
+        if how == "terminated":
+            for i, process in pending.items():
+                sys.stderr.write("omnicored of node %d did not stop within %g seconds, terminating\n" % (i, timeout))
+                process.terminate()
+        elif how == "killed":
+            for i, process in pending.items():
+                sys.stderr.write("omnicored of node %d did not terminate, killing\n" % (i,))
+                process.kill()
+        deadline = None if grace is None else time.time() + grace
+        delays = backoff_delays(maximum=0.1)
+        while pending:
+            for i, process in list(pending.items()):
+                if process.poll() is not None:
+                    times[i] = (time.time() - started, how)
+                    del pending[i]
+            if pending and deadline is not None and time.time() >= deadline:
+                break
+            if pending:
+                time.sleep(next(delays))
+    shutdown_times.update(times)
+    return times
 
 
 def connect_nodes(from_connection, node_num):